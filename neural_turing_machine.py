@@ -20,12 +20,22 @@ files.upload()
 import yaml
 import json
 import logging
-from matplotlib.lines import Line2D      
+import resource
+import os
+import hashlib
+import threading
+import queue
+import asyncio
+import struct
+import collections
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import time
 import random
-import matplotlib.pyplot as plt
 import re
 import sys
+import contextlib
+import functools
 from attr import attrs, attrib, Factory
 from torch import optim
 import attr 
@@ -34,12 +44,70 @@ import numpy as np
 from torch.nn import Parameter 
 from torch import nn 
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 # Default values for program arguments
 RANDOM_SEED = 1000
 REPORT_INTERVAL = 10
 CHECKPOINT_INTERVAL = 1000
 
+"""Profiling"""
+
+class StepProfiler(object):
+    """Optional per-component timers for the NTM step.
+    Each profiled block is a named torch.profiler range and adds its wall
+    time and a call count to a cumulative counter. Times are inclusive of
+    nested blocks, and with CUDA tensors they are host side times.
+    When disabled, `section` returns a shared no-op context and `profiled`
+    functions make a single flag check.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.totals = {}
+        self._null = contextlib.nullcontext()
+
+    def section(self, name):
+        if not self.enabled:
+            return self._null
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            total = self.totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += (time.perf_counter() - start) * 1000
+
+    def reset(self):
+        self.totals = {}
+
+    def summary(self):
+        """A table of the counters, slowest first."""
+        lines = ["{:<32} {:>9} {:>12} {:>10}".format("section", "calls", "total ms", "ms/call")]
+        for name, (calls, ms) in sorted(self.totals.items(), key=lambda t: -t[1][1]):
+            lines += ["{:<32} {:>9} {:>12.2f} {:>10.4f}".format(name, calls, ms, ms / calls)]
+        return "\n".join(lines)
+
+
+PROFILER = StepProfiler()
+
+
+def profiled(name):
+    """Decorator timing every call of a function in :data:`PROFILER`."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            with PROFILER._timed(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
 """# ***Neural Turing Machine***
 
 Model
@@ -48,7 +116,9 @@ Model
 class EncapsulatedNTM(nn.Module):
 
     def __init__(self, num_inputs, num_outputs,
-                 controller_size, controller_layers, num_heads, N, M):
+                 controller_size, controller_layers, num_heads, N, M,
+                 fused_heads=False, checkpoint_segment=0, reversible_memory=False,
+                 sparse_k=0, chunk_size=0, project_inputs=False, defer_output=False):
         """Initialize an EncapsulatedNTM.
         :param num_inputs: External number of inputs. \8 + 1
         :param num_outputs: External number of outputs. \8
@@ -57,6 +127,23 @@ class EncapsulatedNTM(nn.Module):
         :param num_heads: Number of heads. \1
         :param N: Number of rows in the memory bank. \128
         :param M: Number of cols/features in the memory bank. \20
+        :param fused_heads: Use a single :class:`NTMHeadBank` instead of a
+              list of read/write heads.
+        :param checkpoint_segment: If > 0, :meth:`forward_sequence` keeps the
+              state only every `checkpoint_segment` steps and recomputes the
+              steps in between during backward.
+        :param reversible_memory: Rebuild earlier memory states during
+              backward instead of keeping one per step, see :class:`NTMMemory`.
+        :param sparse_k: If > 0, address only the top `sparse_k` memory rows,
+              see :class:`NTMMemory`.
+        :param chunk_size: If > 0, address the memory this many rows at a
+              time, see :class:`NTMMemory`.
+        :param project_inputs: In :meth:`forward_sequence`, project the
+              inputs of all the steps into the controller gates at once, see
+              :meth:`LSTMController.project_inputs`.
+        :param defer_output: In :meth:`forward_sequence`, the steps only keep
+              their features and the output layers run once over all the
+              output steps, see :meth:`NTM.output`.
         """
         super(EncapsulatedNTM, self).__init__()
 
@@ -68,23 +155,63 @@ class EncapsulatedNTM(nn.Module):
         self.num_heads = num_heads
         self.N = N
         self.M = M
+        self.fused_heads = fused_heads
+        self.checkpoint_segment = checkpoint_segment
+        self.reversible_memory = reversible_memory
+        self.sparse_k = sparse_k
+        self.chunk_size = chunk_size
+        self.project_inputs = project_inputs
+        self.defer_output = defer_output
+        # Set by build_flat_buffer
+        self.flat_params = None
+        # Bumped at every weight update, keys the PrefixStateCache entries
+        self.version = 0
+        assert not (checkpoint_segment and reversible_memory), \
+            "Gradient checkpointing and reversible memory can't be combined"
 
         # Create the NTM components
-        memory = NTMMemory(N, M)
+        memory = NTMMemory(N, M, reversible=reversible_memory, sparse_k=sparse_k,
+                           chunk_size=chunk_size)
         # each batch has it own memory
         # we learn paramters of read, write heads and controller 
         # Controller takes in the current input xt and prev read
         controller = LSTMController(num_inputs + M*num_heads, controller_size, controller_layers)
-        heads = nn.ModuleList([])
-        for i in range(num_heads):
-            heads += [
-                NTMReadHead(memory, controller_size),
-                NTMWriteHead(memory, controller_size)
-            ]
+        if fused_heads:
+            heads = NTMHeadBank(memory, controller_size, num_heads)
+        else:
+            heads = nn.ModuleList([])
+            for i in range(num_heads):
+                heads += [
+                    NTMReadHead(memory, controller_size),
+                    NTMWriteHead(memory, controller_size)
+                ]
 
         self.ntm = NTM(num_inputs, num_outputs, controller, memory, heads)
         self.memory = memory
 
+    def state_config(self):
+        """What the layout of :meth:`get_state` depends on."""
+        return {
+            "num_inputs": self.num_inputs, "num_outputs": self.num_outputs,
+            "controller_size": self.controller_size, "controller_layers": self.controller_layers,
+            "num_heads": self.num_heads, "N": self.N, "M": self.M,
+            "fused_heads": self.fused_heads, "reversible_memory": self.reversible_memory,
+        }
+
+    def save_snapshot(self, path, meta=None):
+        """Saves the current state of all the sequences, see :func:`save_state_snapshot`."""
+        save_state_snapshot(path, self.get_state(), dict(meta or {}, config=self.state_config()))
+
+    def load_snapshot(self, path):
+        """Restores a state saved by :meth:`save_snapshot`, memory mapped.
+        :return: the meta dict of the snapshot
+        """
+        state, meta = load_state_snapshot(path)
+        if meta.get("config") != self.state_config():
+            raise ValueError("Snapshot '{}' is of another model: {}".format(path, meta.get("config")))
+        self.set_state(state)
+        return meta
+
     def init_sequence(self, batch_size):
         """Initializing the state."""
         self.batch_size = batch_size
@@ -92,6 +219,40 @@ class EncapsulatedNTM(nn.Module):
         self.previous_state = self.ntm.create_new_state(batch_size)
         # output : init_r, controller_state, heads_state
 
+    def get_state(self):
+        """Returns the current state as a flat tuple of tensors.
+        The order is: reads, controller h/c, heads states, memory.
+        """
+        reads, controller_state, heads_state = self.previous_state
+        return tuple(reads) + tuple(controller_state) + tuple(heads_state) + self.memory.get_state()
+
+    def _split_state(self, state):
+        """The previous_state part of a :meth:`get_state` state, and the memory one."""
+        num_reads = self.ntm.num_read_heads
+        num_heads_state = 2 if self.fused_heads else 2 * self.num_heads
+        state = list(state)
+        reads = state[:num_reads]
+        controller_state = tuple(state[num_reads:num_reads + 2])
+        heads_state = state[num_reads + 2:num_reads + 2 + num_heads_state]
+        return (reads, controller_state, heads_state), state[num_reads + 2 + num_heads_state:]
+
+    def set_state(self, state):
+        """Restores a state returned by :meth:`get_state`."""
+        self.previous_state, memory_state = self._split_state(state)
+        self.memory.set_state(memory_state)
+        self.batch_size = self.memory.batch_size
+
+    def get_state_batch_dims(self):
+        """The batch dimension of each tensor of :meth:`get_state`."""
+        dims = [0] * len(self.get_state())
+        # The LSTM state is (num_layers x batch_size x hidden_size)
+        dims[self.ntm.num_read_heads] = dims[self.ntm.num_read_heads + 1] = 1
+        return dims
+
+    def detach_state(self):
+        """Cuts the state from its history, the sequence itself goes on."""
+        self.set_state([s.detach() for s in self.get_state()])
+
     def forward(self, x=None):
         if x is None:
             x = torch.zeros(self.batch_size, self.num_inputs)
@@ -99,6 +260,178 @@ class EncapsulatedNTM(nn.Module):
         o, self.previous_state = self.ntm(x, self.previous_state)
         return o, self.previous_state
 
+    def forward_sequence(self, X, out_len, lengths=None):
+        """Feed a whole input sequence, then read `out_len` outputs.
+        Runs both phases of :meth:`forward` in one call, the output buffer
+        and the (all zeros) output phase input are allocated once.
+        The state must be initialized with :meth:`init_sequence` first.
+        :param X: input sequence (seq_len x batch_size x num_inputs),
+              including the delimiter.
+        :param out_len: Number of output steps (no input given).
+        :param lengths: Optional length of each sequence of the batch. The
+              sequences are left-padded, the padding steps leave the state
+              of their sample untouched.
+        :return: outputs (out_len x batch_size x num_outputs)
+        """
+        inp_seq_len = X.size(0)
+        if lengths is None:
+            active = [None] * inp_seq_len
+        else:
+            # Sequence b is fed on its last lengths[b] steps before the delimiter
+            first_step = inp_seq_len - 1 - lengths
+            active = list(torch.arange(inp_seq_len).unsqueeze(1) >= first_step.unsqueeze(0))
+
+        if self.checkpoint_segment > 0:
+            return self._forward_sequence_checkpointed(X, out_len, active)
+
+        batch_size = X.size(1)
+        y_out = X.new_empty(out_len, batch_size, self._step_size())
+        zeros = X.new_zeros(batch_size, self.num_inputs)
+        if self.project_inputs:
+            X = self.ntm.controller.project_inputs(X)
+            zeros = self.ntm.controller.project_inputs(zeros)
+
+        # Feed the sequence + delimiter
+        for i in range(inp_seq_len):
+            self._step(X[i], active[i])
+
+        # Read the output (no input given)
+        for i in range(out_len):
+            y_out[i] = self._step(zeros)
+
+        if self.defer_output:
+            y_out = self.ntm.output(y_out)
+        return y_out
+
+    def forward_sequence_cached(self, X, out_len, cache):
+        """:meth:`forward_sequence` from a new sequence, reusing cached states.
+        The input phase continues from the state after the longest prefix of
+        `X` found in `cache` (a :class:`PrefixStateCache`), only the steps
+        after it are computed. The states before the delimiter (the last
+        input) and after it are cached, so a repeated sequence starts at its
+        output and an extended one (more steps, then the delimiter) continues
+        from the steps they share.
+        """
+        keys = cache.prefix_keys(X, self.version)
+        done, state = cache.lookup(keys)
+        if state is None:
+            self.init_sequence(X.size(1))
+        else:
+            self.set_state(state)
+
+        for end in (len(keys) - 1, len(keys)):
+            if done < end:
+                self.forward_sequence(X[done:end], 0)
+                cache.put(keys[end - 1], self.get_state())
+                # Later in place writes must not change the cached tensors
+                self.set_state(self.get_state())
+                done = end
+        return self.forward_sequence(X[:0], out_len)
+
+    def _step_size(self):
+        """Size of what :meth:`_step` returns, the features if the output is deferred."""
+        return self.ntm.fc1.in_features if self.defer_output else self.num_outputs
+
+    def _ntm_step(self, x):
+        if self.defer_output:
+            return self.ntm.step(x, self.previous_state, self.project_inputs)
+        return self.ntm(x, self.previous_state, self.project_inputs)
+
+    def _step(self, x, active=None):
+        """A single step, samples where `active` is False keep their state."""
+        if active is None or bool(active.all()):
+            o, self.previous_state = self._ntm_step(x)
+            return o
+
+        prev_state = self.get_state()
+        if self.sparse_k and not torch.is_grad_enabled():
+            # Sparse writes update the memory in place without autograd
+            prev_state = tuple(s.clone() for s in prev_state)
+        if self.reversible_memory:
+            # Masking the writes keeps the memory on its tape, restoring it
+            # would start a new tape holding a whole memory
+            self.memory.write_mask = active
+            try:
+                o, self.previous_state = self._ntm_step(x)
+            finally:
+                self.memory.write_mask = None
+        else:
+            o, self.previous_state = self._ntm_step(x)
+        state = list(self.get_state())
+        # The reversible memory is already masked
+        num_masked = len(state) - len(self.memory.get_state()) if self.reversible_memory else len(state)
+        for i, dim in enumerate(self.get_state_batch_dims()[:num_masked]):
+            mask = active.view([-1 if d == dim else 1 for d in range(state[i].dim())])
+            state[i] = torch.where(mask, state[i], prev_state[i])
+        if self.reversible_memory:
+            self.previous_state, _ = self._split_state(state)
+        else:
+            self.set_state(state)
+        return o
+
+    def _forward_segment(self, X, active, *state):
+        """Runs the steps of `X` starting from `state`.
+        Returns the outputs followed by the state after the last step. The
+        current state is left untouched, so the segment can be recomputed
+        during backward.
+        """
+        current_state = self.get_state()
+        try:
+            self.set_state(state)
+            y = X.new_empty(X.size(0), X.size(1), self._step_size())
+            for i in range(X.size(0)):
+                y[i] = self._step(X[i], active[i])
+            return (y,) + self.get_state()
+        finally:
+            self.set_state(current_state)
+
+    def _forward_sequence_checkpointed(self, X, out_len, active):
+        """:meth:`forward_sequence` keeping the state only at segment boundaries."""
+        inp_seq_len, batch_size, _ = X.size()
+        y_out = X.new_empty(out_len, batch_size, self._step_size())
+        steps = torch.cat([X, X.new_zeros(out_len, batch_size, self.num_inputs)])
+        if self.project_inputs:
+            steps = self.ntm.controller.project_inputs(steps)
+        active = active + [None] * out_len
+
+        for start in range(0, steps.size(0), self.checkpoint_segment):
+            end = min(start + self.checkpoint_segment, steps.size(0))
+            outp = checkpoint(self._forward_segment, steps[start:end], active[start:end],
+                              *self.get_state(), use_reentrant=False)
+            self.set_state(outp[1:])
+
+            # Only the output phase steps are returned
+            if end > inp_seq_len:
+                first = max(start, inp_seq_len)
+                y_out[first - inp_seq_len:end - inp_seq_len] = outp[0][first - start:]
+
+        if self.defer_output:
+            y_out = self.ntm.output(y_out)
+        return y_out
+
+    def build_flat_buffer(self):
+        """Moves all the parameters and their gradients into flat buffers.
+        The parameters stay registered as they are, their data and grad
+        become views of the `flat_params` tensor and of its grad. Clipping,
+        norms, penalties and the optimizer step then each run as a single
+        op on the whole model: pass `[net.flat_params]` to the optimizer and
+        reset the gradients with :func:`zero_grads`.
+        Call it after the model is on its final device and dtype, moving it
+        afterwards makes new tensors that aren't views of the buffers.
+        :return: the flat parameter tensor
+        """
+        params = list(self.parameters())
+        flat = torch.cat([p.data.reshape(-1) for p in params]).requires_grad_()
+        flat.grad = torch.zeros_like(flat)
+        offset = 0
+        for p in params:
+            n = p.numel()
+            p.data = flat.data[offset:offset + n].view_as(p)
+            p.grad = flat.grad[offset:offset + n].view_as(p)
+            offset += n
+        self.flat_params = flat
+        return flat
+
     def calculate_num_params(self):
         """Returns the total number of parameters."""
         num_params = 0
@@ -129,8 +462,9 @@ class LSTMController(nn.Module):
 
     def create_new_state(self, batch_size):
         # Dimension: (num_layers * num_directions, batch, hidden_size)
-        lstm_h = self.lstm_h_bias.clone().repeat(1, batch_size, 1)
-        lstm_c = self.lstm_c_bias.clone().repeat(1, batch_size, 1)
+        # Broadcast views of the biases, the first step makes real tensors
+        lstm_h = self.lstm_h_bias.expand(-1, batch_size, -1)
+        lstm_c = self.lstm_c_bias.expand(-1, batch_size, -1)
         return lstm_h, lstm_c
 
     def reset_parameters(self):
@@ -144,20 +478,67 @@ class LSTMController(nn.Module):
     def size(self):
         return self.num_inputs, self.num_outputs
 
-    def forward(self, x, prev_state):
+    def project_inputs(self, X):
+        """First layer gate pre-activations of the external inputs, both biases included.
+        The first X.size(-1) inputs of the controller are the external ones.
+        :param X: external inputs of every step (seq_len x batch_size x n)
+        :return: (seq_len x batch_size x 4*num_outputs), one row per step
+              to pass as `x_proj` to :meth:`forward`.
+        """
+        w = self.lstm.weight_ih_l0[:, :X.size(-1)]
+        return torch.matmul(X, w.t()) + (self.lstm.bias_ih_l0 + self.lstm.bias_hh_l0)
+
+    def forward(self, x, prev_state, x_proj=None):
+        """LSTMController forward function.
+        :param x: controller input (batch_size x num_inputs), or only its
+              last inputs (the read vectors) if `x_proj` is given.
+        :param prev_state: previous (h, c)
+        :param x_proj: this step's row of :meth:`project_inputs` for the
+              external inputs, the step then runs on :meth:`_cell`.
+        """
+        if x_proj is not None:
+            return self._forward_projected(x, prev_state, x_proj)
+
         x = x.unsqueeze(0) # x = [1, bs, dim + M*num_heads]
+        prev_state = tuple(s.contiguous() for s in prev_state)
         outp, state = self.lstm(x, prev_state)
         return outp.squeeze(0), state
 
+    def _forward_projected(self, x, prev_state, x_proj):
+        """A step of the LSTM layers with the external input part precomputed."""
+        prev_h, prev_c = prev_state
+        h, c = [], []
+        for layer in range(self.num_layers):
+            w_ih = getattr(self.lstm, 'weight_ih_l%d' % layer)
+            w_hh = getattr(self.lstm, 'weight_hh_l%d' % layer)
+            if layer == 0:
+                gates = torch.addmm(x_proj, x, w_ih[:, w_ih.size(1) - x.size(1):].t())
+            else:
+                bias = getattr(self.lstm, 'bias_ih_l%d' % layer) + getattr(self.lstm, 'bias_hh_l%d' % layer)
+                gates = torch.addmm(bias, h[-1], w_ih.t())
+            gates = torch.addmm(gates, prev_h[layer], w_hh.t())
+            h_layer, c_layer = self._cell(gates, prev_c[layer])
+            h += [h_layer]
+            c += [c_layer]
+        return h[-1], (torch.stack(h), torch.stack(c))
+
+    @staticmethod
+    def _cell(gates, c):
+        """LSTM cell update from the gate pre-activations, in the nn.LSTM order i, f, g, o."""
+        i, f, g, o = gates.chunk(4, dim=1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        return h, c
+
 """head"""
 
 def _split_cols(mat, lengths):
-    """Split a 2D matrix to variable length columns."""
-    assert mat.size()[1] == sum(lengths), "Lengths must be summed to num columns"
+    """Split a matrix to variable length columns (along the last dim)."""
+    assert mat.size(-1) == sum(lengths), "Lengths must be summed to num columns"
     l = np.cumsum([0] + lengths)
     results = []
     for s, e in zip(l[:-1], l[1:]):
-        results += [mat[:, s:e]]
+        results += [mat[..., s:e]]
     return results
 
 
@@ -184,6 +565,7 @@ class NTMHeadBase(nn.Module):
     def is_read_head(self):
         return NotImplementedError
 
+    @profiled("NTMHeadBase._address_memory")
     def _address_memory(self, k, β, g, s, γ, w_prev):
         # Handle Activations
         k = k.clone()
@@ -274,29 +656,286 @@ class NTMWriteHead(NTMHeadBase):
 
         return w
 
+
+class NTMHeadBank(NTMHeadBase):
+    """A fused bank of `num_heads` read heads and `num_heads` write heads.
+
+    Replaces the [read, write] * num_heads list of heads. The parameters of
+    all heads are stacked, so every step does one projection for all heads.
+    The heads then run in the order of the head list: each pair addresses
+    the memory as written by the previous pairs, reads, then writes. The
+    read and write head of a pair see the same memory and are addressed
+    together, one batched [bs, 2, N] addressing per pair.
+    """
+    def __init__(self, memory, controller_size, num_heads, hidden_size=224):
+        super(NTMHeadBank, self).__init__(memory, controller_size)
+        self.num_heads = num_heads
+        self.hidden_size = hidden_size
+
+        # Corresponding to k, β, g, s, γ (and e, a) sizes from the paper
+        self.read_lengths = [self.M, 1, 1, 3, 1]
+        self.write_lengths = [self.M, 1, 1, 3, 1, self.M, self.M]
+
+        # fc_hide of all heads, ordered [read_0 .. read_H-1, write_0 .. write_H-1]
+        self.fc_hide = nn.Linear(controller_size, 2 * num_heads * hidden_size)
+        self.read_weight = Parameter(torch.Tensor(num_heads, hidden_size, sum(self.read_lengths)))
+        self.read_bias = Parameter(torch.Tensor(num_heads, 1, sum(self.read_lengths)))
+        self.write_weight = Parameter(torch.Tensor(num_heads, hidden_size, sum(self.write_lengths)))
+        self.write_bias = Parameter(torch.Tensor(num_heads, 1, sum(self.write_lengths)))
+        self.relu = nn.ReLU()
+        self.reset_parameters()
+
+    def create_new_state(self, batch_size):
+        # Previous read and write weightings, each [bs, H, N]
+        return [torch.zeros(batch_size, self.num_heads, self.N),
+                torch.zeros(batch_size, self.num_heads, self.N)]
+
+    def reset_parameters(self):
+        # Same initialization as the per-head fc_read / fc_write layers
+        for h in range(self.num_heads):
+            nn.init.xavier_uniform_(self.read_weight[h], gain=1.4)
+            nn.init.xavier_uniform_(self.write_weight[h], gain=1.4)
+        nn.init.normal_(self.read_bias, std=0.01)
+        nn.init.normal_(self.write_bias, std=0.01)
+
+    def is_read_head(self):
+        return True
+
+    @profiled("NTMHeadBank._address_memory")
+    def _address_memory(self, k, β, g, s, γ, w_prev):
+        # Handle Activations
+        β = F.softplus(β)
+        g = torch.sigmoid(g)
+        s = F.softmax(s, dim=-1)
+        γ = 1 + F.softplus(γ)
+
+        return self.memory.address_heads(k, β, g, s, γ, w_prev)
+
+    def forward(self, embeddings, prev_state):
+        """NTMHeadBank forward function.
+        :param embeddings: input representation of the controller.
+        :param prev_state: previous read and write weightings ([bs, H, N] each)
+        :return: list of H read vectors and the new [w_read, w_write] state
+        """
+        H = self.num_heads
+        w_read_prev, w_write_prev = prev_state
+
+        o = self.relu(self.fc_hide(embeddings))
+        o = o.view(-1, 2 * H, self.hidden_size).transpose(0, 1) # o = [2H, bs, hidden]
+        o_read = torch.baddbmm(self.read_bias, o[:H], self.read_weight).transpose(0, 1)
+        o_write = torch.baddbmm(self.write_bias, o[H:], self.write_weight).transpose(0, 1)
+        read_params = _split_cols(o_read, self.read_lengths) # k, β, g, s, γ
+        write_params = _split_cols(o_write, self.write_lengths) # k, β, g, s, γ, e, a
+        e, a = write_params[5:]
+
+        # e should be in [0, 1]
+        e = torch.sigmoid(e)
+
+        reads, w_read, w_write = [], [], []
+        for h in range(H):
+            # Address the read and write head of the pair at once, w = [bs, 2, N]
+            k, β, g, s, γ = [torch.cat([rp[:, h:h + 1], wp[:, h:h + 1]], dim=1)
+                             for rp, wp in zip(read_params, write_params)]
+            w_prev = torch.stack([w_read_prev[:, h], w_write_prev[:, h]], dim=1)
+            w = self._address_memory(k, β, g, s, γ, w_prev)
+
+            # Read from memory, then write to it
+            reads.append(self.memory.read_heads(w[:, :1])[:, 0])
+            self.memory.write(w[:, 1], e[:, h], a[:, h])
+            w_read.append(w[:, 0])
+            w_write.append(w[:, 1])
+
+        return reads, [torch.stack(w_read, dim=1), torch.stack(w_write, dim=1)]
+
 """memory"""
 
 def _convolve(w, s):
-    """Circular convolution implementation."""
-    assert s.size(0) == 3
-    t = torch.cat([w[-1:], w, w[:1]])
-    c = F.conv1d(t.view(1, 1, -1), s.view(1, 1, -1)).view(-1)
+    """Circular convolution implementation.
+    Batched over the first dimension, each row of `w` (batch_size x N) is
+    convolved with its own kernel from `s` (batch_size x K), K odd.
+    The batch is folded into the channels of a single grouped conv1d.
+    """
+    batch_size, K = s.size()
+    assert K % 2 == 1, "Shift kernel size must be odd"
+    p = K // 2
+    assert p <= w.size(1), "Shift kernel must not be wider than the memory"
+    t = torch.cat([w[:, w.size(1) - p:], w, w[:, :p]], dim=1) # t = [bs, N + K - 1]
+    c = F.conv1d(t.unsqueeze(0), s.unsqueeze(1), groups=batch_size).squeeze(0)
     return c
 
 
+def _wrapped(t, dim, start, end):
+    """Entries `start` to `end` of `t` along `dim`, wrapping around its ends."""
+    n = t.size(dim)
+    if 0 <= start and end <= n:
+        return t.narrow(dim, start, end - start)
+    return t.index_select(dim, torch.arange(start, end, device=t.device) % n)
+
+
+class _MemoryTape(object):
+    """Log of the writes to the memory of a sequence.
+    Keeps only the latest memory and the (w, e, a) of every write, an earlier
+    memory state is rebuilt by undoing the writes that followed it:
+        prev_mem = (memory - w a^T) / (1 - w e^T)
+    Each undo can scale the rounding errors by up to 1 / (1 - max(w e^T)).
+    Once the undos back to the last exact memory would scale them by more
+    than `max_amplification`, the memory before the write is kept as is,
+    so a rebuilt memory is never more than that far from an exact one.
+    """
+    def __init__(self, memory, max_amplification=100.0):
+        self.memory = memory.detach()
+        self.version = 0
+        self.writes = []
+        self.max_amplification = max_amplification
+        # Exact memories, by version
+        self.kept = {}
+        self.amplification = 1.0
+
+    def record(self, memory, w, e, a):
+        # w and e are >= 0, the largest w e^T is max(w) max(e)
+        erase = float((w.amax(-1) * e.amax(-1)).max())
+        undo = 1 / max(1 - erase, 1e-12)
+        if self.amplification * undo > self.max_amplification:
+            self.kept[len(self.writes)] = self.memory
+            self.amplification = 1.0
+        else:
+            self.amplification *= undo
+        self.writes += [(w.detach(), e.detach(), a.detach())]
+        self.memory = memory.detach()
+        self.version = len(self.writes)
+
+    def get(self, version):
+        """Returns the memory as it was after the first `version` writes."""
+        while self.version > version:
+            prev_mem = self.kept.get(self.version - 1)
+            if prev_mem is None:
+                w, e, a = self.writes[self.version - 1]
+                w = w.unsqueeze(-1)
+                prev_mem = (self.memory - w * a.unsqueeze(1)) / (1 - w * e.unsqueeze(1))
+            self.memory = prev_mem
+            self.version -= 1
+        while self.version < version:
+            w, e, a = self.writes[self.version]
+            w = w.unsqueeze(-1)
+            self.memory = self.memory * (1 - w * e.unsqueeze(1)) + w * a.unsqueeze(1)
+            self.version += 1
+        return self.memory
+
+
+class _ReversibleWrite(torch.autograd.Function):
+    """memory * (1 - w e^T) + w a^T, saving only w, e, a for backward."""
+
+    @staticmethod
+    def forward(ctx, memory, w, e, a, tape):
+        ctx.tape = tape
+        ctx.version = tape.version
+        ctx.save_for_backward(w, e, a)
+        erase = torch.matmul(w.unsqueeze(-1), e.unsqueeze(1))
+        add = torch.matmul(w.unsqueeze(-1), a.unsqueeze(1))
+        memory = memory * (1 - erase) + add
+        tape.record(memory, w, e, a)
+        return memory
+
+    @staticmethod
+    def backward(ctx, grad):
+        w, e, a = ctx.saved_tensors
+        prev_mem = ctx.tape.get(ctx.version)
+        grad_mem = grad * (1 - torch.matmul(w.unsqueeze(-1), e.unsqueeze(1)))
+        grad_erase = grad * prev_mem
+        grad_w = torch.matmul(grad, a.unsqueeze(-1)).squeeze(-1) - \
+            torch.matmul(grad_erase, e.unsqueeze(-1)).squeeze(-1)
+        grad_e = -torch.matmul(w.unsqueeze(1), grad_erase).squeeze(1)
+        grad_a = torch.matmul(w.unsqueeze(1), grad).squeeze(1)
+        return grad_mem, grad_w, grad_e, grad_a, None
+
+
+class _ReversibleRead(torch.autograd.Function):
+    """w[bs, H, N] x memory[bs, N, M], without saving the memory."""
+
+    @staticmethod
+    def forward(ctx, memory, w, tape):
+        ctx.tape = tape
+        ctx.version = tape.version
+        ctx.save_for_backward(w)
+        return torch.bmm(w, memory)
+
+    @staticmethod
+    def backward(ctx, grad):
+        w, = ctx.saved_tensors
+        memory = ctx.tape.get(ctx.version)
+        return torch.bmm(w.transpose(1, 2), grad), torch.bmm(grad, memory.transpose(1, 2)), None
+
+
+class _ReversibleSimilarity(torch.autograd.Function):
+    """Cosine similarity of k[bs, H, M] with every memory row, without
+    saving the memory. Returns [bs, H, N].
+    """
+
+    @staticmethod
+    def forward(ctx, memory, k, tape, eps=1e-8):
+        ctx.tape = tape
+        ctx.version = tape.version
+        mem_norm = memory.norm(dim=-1).clamp_min(eps).unsqueeze(1) # [bs, 1, N]
+        k_norm = k.norm(dim=-1).clamp_min(eps).unsqueeze(-1) # [bs, H, 1]
+        sim = torch.bmm(k, memory.transpose(1, 2)) / (k_norm * mem_norm)
+        ctx.save_for_backward(k, sim, mem_norm, k_norm)
+        return sim
+
+    @staticmethod
+    def backward(ctx, grad):
+        k, sim, mem_norm, k_norm = ctx.saved_tensors
+        memory = ctx.tape.get(ctx.version)
+        grad_dot = grad / (k_norm * mem_norm)
+        grad_sim = grad * sim
+        grad_k = torch.bmm(grad_dot, memory) - grad_sim.sum(-1, keepdim=True) * k / k_norm ** 2
+        grad_mem = torch.bmm(grad_dot.transpose(1, 2), k) - \
+            (grad_sim.sum(1) / mem_norm.squeeze(1) ** 2).unsqueeze(-1) * memory
+        return grad_mem, grad_k, None, None
+
+
+def _sparse_lookup(rows, idx, val):
+    """The entries at `rows` of the sparse vectors given by `idx`/`val` ([..., K]).
+    `rows` is [..., P, S], rows that aren't in `idx` are 0.
+    """
+    match = rows.unsqueeze(-1) == idx.unsqueeze(-2).unsqueeze(-2)
+    return (match * val.unsqueeze(-2).unsqueeze(-2)).sum(dim=-1)
+
+
 class NTMMemory(nn.Module):
     """Memory bank for NTM."""
-    def __init__(self, N, M):
+    def __init__(self, N, M, reversible=False, max_erase=0.99, sparse_k=0, chunk_size=0):
         """Initialize the NTM Memory matrix.
         The memory's dimensions are (batch_size x N x M).
         Each batch has it's own memory matrix.
         :param N: Number of rows in the memory.
         :param M: Number of columns/features in the memory.
+        :param reversible: Don't keep the memory of every step for backward,
+              only the write vectors (see :class:`_MemoryTape`). Memory use
+              goes from O(T*N*M) to O(N*M + T*(N+M)) per sequence, plus the
+              memories kept where a write can't be undone precisely.
+        :param max_erase: In reversible mode the erase vector is scaled by
+              this, so that a written row can always be rebuilt.
+        :param sparse_k: If > 0, every weighting is cut down to its top
+              `sparse_k` rows: the content weighting is a softmax over the
+              most similar rows only, and reads/writes gather/scatter just
+              those rows instead of touching the whole matrix.
+        :param chunk_size: If > 0, addressing goes through the memory this
+              many rows at a time, so its temporaries don't grow with N.
         """
         super(NTMMemory, self).__init__()
 
         self.N = N
         self.M = M
+        self.reversible = reversible
+        self.max_erase = max_erase
+        self.sparse_k = min(sparse_k, N)
+        self.chunk_size = chunk_size
+        assert not (sparse_k and reversible), \
+            "Sparse addressing and reversible memory can't be combined"
+        assert not (chunk_size and (sparse_k or reversible)), \
+            "Chunked addressing is only for the dense memory"
+        # In reversible mode, the samples where it's False don't write
+        self.write_mask = None
 
         # The memory bias allows the heads to learn how to initially address
         # memory locations by content
@@ -308,13 +947,40 @@ class NTMMemory(nn.Module):
         nn.init.uniform_(self.mem_bias, -stdev, stdev)
 
     def reset(self, batch_size):
-        """Initialize memory from bias, for start-of-sequence."""
+        """Initialize memory from bias, for start-of-sequence.
+        The memory is a broadcast view of the bias until the first write
+        makes a real [batch_size, N, M] tensor of it, so nothing is copied
+        here.
+        """
         self.batch_size = batch_size
-        self.memory = self.mem_bias.clone().repeat(batch_size, 1, 1)
+        self.memory = self.mem_bias.expand(batch_size, -1, -1)
+        self.owns_memory = False
+        if self.reversible:
+            self.tape = _MemoryTape(self.memory)
+        else:
+            # Row norms for content addressing, kept up to date by write
+            self.norms = self._row_norms(self.mem_bias).expand(batch_size, -1)
+
+    def get_state(self):
+        """The tensors holding the memory of the current sequence."""
+        if self.reversible:
+            return (self.memory,)
+        return (self.memory, self.norms)
+
+    def set_state(self, state):
+        """Restores tensors returned by :meth:`get_state`."""
+        self.memory = state[0]
+        self.owns_memory = False
+        self.batch_size = self.memory.size(0)
+        if self.reversible:
+            self.tape = _MemoryTape(self.memory)
+        else:
+            self.norms = state[1]
 
     def size(self):
         return self.N, self.M
 
+    @profiled("NTMMemory.read")
     def read(self, w):
         """Read from memory (according to section 3.1)."""
         """
@@ -322,17 +988,84 @@ class NTMMemory(nn.Module):
 
         """
         # print("read", w)
+        if self.reversible:
+            return _ReversibleRead.apply(self.memory, w.unsqueeze(1), self.tape).squeeze(1)
+        if self.sparse_k:
+            return self._sparse_read(w.unsqueeze(1)).squeeze(1)
         return torch.matmul(w.unsqueeze(1), self.memory).squeeze(1)
 
+    @profiled("NTMMemory.read_heads")
+    def read_heads(self, w):
+        """Read for a bank of heads, w = [bs, H, N], returns [bs, H, M]."""
+        if self.reversible:
+            return _ReversibleRead.apply(self.memory, w, self.tape)
+        if self.sparse_k:
+            return self._sparse_read(w)
+        return torch.bmm(w, self.memory)
+
+    def _gather_rows(self, w):
+        """The top `sparse_k` entries of w = [bs, R, N] and their memory rows.
+        Returns the weights [bs, R, K], row indices [bs, R, K] and rows [bs, R, K, M].
+        """
+        bs, R, _ = w.size()
+        val, idx = w.topk(self.sparse_k, dim=-1)
+        rows = self.memory.gather(1, idx.view(bs, -1, 1).expand(-1, -1, self.M))
+        return val, idx, rows.view(bs, R, self.sparse_k, self.M)
+
+    def _sparse_read(self, w):
+        val, _, rows = self._gather_rows(w)
+        return torch.matmul(val.unsqueeze(2), rows).squeeze(2)
+
+    @profiled("NTMMemory.write")
     def write(self, w, e, a):
         """write to memory (according to section 3.2)."""
         # print("write", w)
-        self.prev_mem = self.memory
-        self.memory = torch.Tensor(self.batch_size, self.N, self.M)
+        if self.reversible:
+            e = e * self.max_erase
+            if self.write_mask is not None:
+                # A 0 weighting leaves the memory exactly as it was
+                w = w * self.write_mask.unsqueeze(-1).to(w.dtype)
+            self.memory = _ReversibleWrite.apply(self.memory, w, e, a, self.tape)
+            return
+        if self.sparse_k:
+            self._sparse_write(w, e, a)
+            return
+
         erase = torch.matmul(w.unsqueeze(-1), e.unsqueeze(1))
         add = torch.matmul(w.unsqueeze(-1), a.unsqueeze(1))
-        self.memory = self.prev_mem * (1 - erase) + add
-
+        self.memory = self.memory * (1 - erase) + add
+        # A dense weighting writes to every row, the sparse write updates
+        # only the norms of its rows
+        self.norms = self._row_norms(self.memory)
+
+    @staticmethod
+    def _row_norms(rows):
+        # Clamped as in F.cosine_similarity
+        return rows.norm(dim=-1).clamp(min=1e-8)
+
+    def _sparse_write(self, w, e, a):
+        """Erase/add on the top `sparse_k` rows of w only.
+        Without autograd the rows are written in place, so the step costs
+        O(K*M) instead of a copy of the whole memory.
+        """
+        val, idx, rows = self._gather_rows(w.unsqueeze(1))
+        val, idx, rows = val[:, 0].unsqueeze(-1), idx[:, 0], rows[:, 0]
+        rows = rows * (1 - val * e.unsqueeze(1)) + val * a.unsqueeze(1)
+        idx = idx.unsqueeze(-1).expand(-1, -1, self.M)
+        norms = self._row_norms(rows)
+        if torch.is_grad_enabled():
+            self.memory = self.memory.scatter(1, idx, rows)
+            self.norms = self.norms.scatter(1, idx[..., 0], norms)
+        else:
+            if not self.owns_memory:
+                # The memory may still be the bias, or a state held elsewhere
+                self.memory = self.memory.clone(memory_format=torch.contiguous_format)
+                self.norms = self.norms.clone(memory_format=torch.contiguous_format)
+                self.owns_memory = True
+            self.memory.scatter_(1, idx, rows)
+            self.norms.scatter_(1, idx[..., 0], norms)
+
+    @profiled("NTMMemory.address")
     def address(self, k, β, g, s, γ, w_prev):
         """NTM Addressing (according to section 3.3).
         Returns a softmax weighting over the rows of the memory matrix.
@@ -343,6 +1076,13 @@ class NTMMemory(nn.Module):
         :param γ: Sharpen weighting scalar.
         :param w_prev: The weighting produced in the previous time step.
         """
+        if self.sparse_k:
+            return self._sparse_address(k.unsqueeze(1), β.unsqueeze(1), g.unsqueeze(1),
+                                        s.unsqueeze(1), γ.unsqueeze(1), w_prev.unsqueeze(1)).squeeze(1)
+        if self.chunk_size:
+            return self._chunked_address(k.unsqueeze(1), β.unsqueeze(1), g.unsqueeze(1),
+                                         s.unsqueeze(1), γ.unsqueeze(1), w_prev.unsqueeze(1)).squeeze(1)
+
         # Content focus
 
         wc = self._similarity(k, β) # wc = [bs, N]
@@ -354,23 +1094,162 @@ class NTMMemory(nn.Module):
 
         return w
 
+    @profiled("NTMMemory.address_heads")
+    def address_heads(self, k, β, g, s, γ, w_prev):
+        """NTM Addressing for a bank of H heads at once.
+        Same as :meth:`address`, every argument has an extra head dimension
+        after the batch one, e.g. k = [bs, H, M] and w_prev = [bs, H, N].
+        Returns the [bs, H, N] weightings.
+        """
+        bs, H, _ = k.size()
+
+        if self.sparse_k:
+            return self._sparse_address(k, β, g, s, γ, w_prev)
+        if self.chunk_size:
+            return self._chunked_address(k, β, g, s, γ, w_prev)
+
+        # Content focus
+        wc = self._similarity_heads(k, β) # wc = [bs, H, N]
+
+        # Location focus, rows are independent so the heads go in the batch
+        wg = self._interpolate(w_prev.reshape(bs * H, -1), wc.view(bs * H, -1), g.reshape(bs * H, 1))
+        ŵ = self._shift(wg, s.reshape(bs * H, -1))
+        w = self._sharpen(ŵ, γ.reshape(bs * H, 1))
+
+        return w.view(bs, H, -1)
+
+    @profiled("NTMMemory._similarity")
     def _similarity(self, k, β):
 
         k = k.view(self.batch_size, 1, -1) # k = [bs, 1, M]
 
-        w = F.softmax(β * F.cosine_similarity(self.memory + 1e-16, k + 1e-16, dim=-1), dim=1) # sim(Mem[bs, N, M], K[bs, 1, M]) 
+        if self.reversible:
+            sim = _ReversibleSimilarity.apply(self.memory, k, self.tape).squeeze(1)
+            return F.softmax(β * sim, dim=1)
+        if self.sparse_k:
+            return self._dense_similarity(k, β.view(self.batch_size, 1, 1)).squeeze(1)
+
+        w = F.softmax(β * self._cosine_similarity(k).squeeze(1), dim=1) # sim(Mem[bs, N, M], K[bs, 1, M]) 
 
         return w
 
+    @profiled("NTMMemory._similarity_heads")
+    def _similarity_heads(self, k, β):
+        if self.reversible:
+            return F.softmax(β * _ReversibleSimilarity.apply(self.memory, k, self.tape), dim=-1)
+        if self.sparse_k:
+            return self._dense_similarity(k, β)
+
+        # sim(Mem[bs, N, M], K[bs, H, M]) = [bs, H, N]
+        return F.softmax(β * self._cosine_similarity(k), dim=-1)
+
+    def _cosine_similarity(self, k):
+        """Cosine similarity of k = [bs, R, M] with every row, returns [bs, R, N].
+        Only the dot products are computed here, the row norms are cached.
+        """
+        dot = torch.matmul(k, self.memory.transpose(1, 2))
+        return dot / (self._row_norms(k).unsqueeze(-1) * self.norms.unsqueeze(1))
+
+    @profiled("NTMMemory._sparse_address")
+    def _sparse_address(self, k, β, g, s, γ, w_prev):
+        """Addressing restricted to the top `sparse_k` rows.
+        Every argument has a head dimension after the batch one, as in
+        :meth:`address_heads`. The interpolation and shift only run on the
+        rows the content and previous weightings select (and their shifted
+        neighbours), and the sharpened weighting is cut down to its top
+        `sparse_k` rows. Returns the [bs, R, N] weightings, 0 outside them.
+        """
+        wc, idx_c = self._sparse_similarity(k, β)
+        w_prev, idx_prev = w_prev.topk(self.sparse_k, dim=-1)
+
+        # The rows with a nonzero shifted weighting, w[i] = sum_j s[j] wg[i + j - c]
+        S = s.size(-1)
+        offsets = torch.arange(S, device=s.device) - S // 2
+        rows = torch.cat([idx_c, idx_prev], dim=-1)
+        rows = (rows.unsqueeze(-1) - offsets).flatten(-2) % self.N # [bs, R, 2KS]
+        src = (rows.unsqueeze(-1) + offsets) % self.N # [bs, R, 2KS, S]
+
+        wg = g.unsqueeze(-1) * _sparse_lookup(src, idx_c, wc) + \
+            (1 - g.unsqueeze(-1)) * _sparse_lookup(src, idx_prev, w_prev)
+        ŵ = torch.matmul(wg, s.unsqueeze(-1)).squeeze(-1)
+        w = ŵ ** γ
+
+        # A row can be reached more than once, keep only the first
+        rows, order = rows.sort(dim=-1)
+        w = w.gather(-1, order)
+        dup = torch.zeros_like(rows, dtype=torch.bool)
+        dup[..., 1:] = rows[..., 1:] == rows[..., :-1]
+        w = w.masked_fill(dup, -1)
+
+        w, top = w.topk(self.sparse_k, dim=-1)
+        w = w / (w.sum(dim=-1, keepdim=True) + 1e-16)
+        return w.new_zeros(w.size()[:-1] + (self.N,)).scatter(-1, rows.gather(-1, top), w)
+
+    @profiled("NTMMemory._chunked_address")
+    def _chunked_address(self, k, β, g, s, γ, w_prev):
+        """Addressing that goes through the memory `chunk_size` rows at a time.
+        Every argument has a head dimension after the batch one, as in
+        :meth:`address_heads`. A first pass gets the max and the sum of the
+        exponentials of the content logits (online softmax). A second one
+        builds the content, interpolated, shifted and sharpened weightings
+        chunk by chunk, recomputing the logits of the rows on each side that
+        the shift reads from. Apart from the returned [bs, R, N] weightings
+        the temporaries are O(chunk_size) per head.
+        """
+        C, S = self.chunk_size, s.size(-1)
+        p = S // 2
+        k_norm = self._row_norms(k).unsqueeze(-1)
+
+        def logits(start, end):
+            memory = _wrapped(self.memory, 1, start, end)
+            norms = _wrapped(self.norms, 1, start, end).unsqueeze(1)
+            return β * torch.matmul(k, memory.transpose(1, 2)) / (k_norm * norms)
+
+        # Softmax normalizer, m = max and l = sum(exp(logits - m))
+        for start in range(0, self.N, C):
+            x = logits(start, min(start + C, self.N))
+            x_max = x.max(dim=-1, keepdim=True)[0]
+            if start == 0:
+                m, l = x_max, torch.exp(x - x_max).sum(dim=-1, keepdim=True)
+            else:
+                m_new = torch.max(m, x_max)
+                l = l * torch.exp(m - m_new) + torch.exp(x - m_new).sum(dim=-1, keepdim=True)
+                m = m_new
+
+        w = k.new_empty(k.size()[:-1] + (self.N,))
+        for start in range(0, self.N, C):
+            end = min(start + C, self.N)
+            wc = torch.exp(logits(start - p, end + p) - m) / l
+            wg = g * wc + (1 - g) * _wrapped(w_prev, 2, start - p, end + p)
+            ŵ = torch.matmul(wg.unfold(-1, S, 1), s.unsqueeze(-1)).squeeze(-1)
+            w[..., start:end] = ŵ ** γ
+
+        if torch.is_grad_enabled():
+            return w / (w.sum(dim=-1, keepdim=True) + 1e-16)
+        return w.div_(w.sum(dim=-1, keepdim=True) + 1e-16)
+
+    def _sparse_similarity(self, k, β):
+        """Content weighting over the top `sparse_k` rows, k = [bs, R, M].
+        The cosine similarity is a single [bs, R, N] matmul, the softmax only
+        runs over the selected rows. Returns the [bs, R, K] weights and rows.
+        """
+        sim, idx = self._cosine_similarity(k).topk(self.sparse_k, dim=-1)
+        return F.softmax(β * sim, dim=-1), idx
+
+    def _dense_similarity(self, k, β):
+        """:meth:`_sparse_similarity` as [bs, R, N] weightings, 0 outside the top rows."""
+        wc, idx = self._sparse_similarity(k, β)
+        return wc.new_zeros(wc.size()[:-1] + (self.N,)).scatter(-1, idx, wc)
+
+    @profiled("NTMMemory._interpolate")
     def _interpolate(self, w_prev, wc, g):
         return g * wc + (1 - g) * w_prev
 
+    @profiled("NTMMemory._shift")
     def _shift(self, wg, s):
-        result = torch.zeros(wg.size())
-        for b in range(self.batch_size):
-            result[b] = _convolve(wg[b], s[b])
-        return result
+        return _convolve(wg, s)
 
+    @profiled("NTMMemory._sharpen")
     def _sharpen(self, ŵ, γ):
         w = ŵ ** γ
         w = torch.div(w, torch.sum(w, dim=1).view(-1, 1) + 1e-16)
@@ -390,6 +1269,7 @@ class NTM(nn.Module):
         : This design allows the flexibility of using any number of read and
               write heads independently, also, the order by which the heads are
               called in controlled by the user (order in list)
+              A fused :class:`NTMHeadBank` may be given instead of the list.
         """
         super(NTM, self).__init__()
         self.relu = nn.ReLU()
@@ -403,18 +1283,22 @@ class NTM(nn.Module):
         self.N, self.M = memory.size()
         _, self.controller_size = controller.size()
 
+        if isinstance(heads, NTMHeadBank):
+            read_heads = range(heads.num_heads)
+        else:
+            read_heads = [head for head in heads if head.is_read_head()]
+
         # Initialize the initial previous read values to random biases
         self.num_read_heads = 0
         self.init_r = []
-        for head in heads:
-            if head.is_read_head():
-                # r = sum_i w_t(i) M_t(i)
-                # dim(r) = M
-                # init_r to feed it into controller
-                init_r_bias = torch.zeros(1, self.M) 
-                self.register_buffer("read{}_bias".format(self.num_read_heads), init_r_bias.data)
-                self.init_r += [init_r_bias]
-                self.num_read_heads += 1
+        for _ in read_heads:
+            # r = sum_i w_t(i) M_t(i)
+            # dim(r) = M
+            # init_r to feed it into controller
+            init_r_bias = torch.zeros(1, self.M) 
+            self.register_buffer("read{}_bias".format(self.num_read_heads), init_r_bias.data)
+            self.init_r += [init_r_bias]
+            self.num_read_heads += 1
 
         assert self.num_read_heads > 0, "heads list must contain at least a single read head"
 
@@ -426,12 +1310,15 @@ class NTM(nn.Module):
         self.reset_parameters()
 
     def create_new_state(self, batch_size):
-        init_r = [r.clone().repeat(batch_size, 1) for r in self.init_r] 
+        init_r = [r.expand(batch_size, -1) for r in self.init_r] 
         # read heads reset 
         # dim = [n, bs, M]
         controller_state = self.controller.create_new_state(batch_size) 
         # LSTM controller reset, output : lstm_h, lstm_c
-        heads_state = [head.create_new_state(batch_size) for head in self.heads] 
+        if isinstance(self.heads, NTMHeadBank):
+            heads_state = self.heads.create_new_state(batch_size)
+        else:
+            heads_state = [head.create_new_state(batch_size) for head in self.heads] 
         # reset read & write head values
         # dim = [n, bs, N]
 
@@ -444,67 +1331,160 @@ class NTM(nn.Module):
         nn.init.xavier_uniform_(self.fc2.weight, gain=1)
         nn.init.normal_(self.fc2.bias, std=0.01)
 
-    def forward(self, x, prev_state):
+    @profiled("NTM.forward")
+    def forward(self, x, prev_state, projected=False):
         """NTM forward function.
         :param x: input vector (batch_size x num_inputs)
         :param prev_state: The previous state of the NTM
+        :param projected: `x` is the external input already projected by
+              :meth:`LSTMController.project_inputs`.
+        """
+        features, state = self.step(x, prev_state, projected)
+        return self.output(features), state
+
+    @profiled("NTM.output")
+    def output(self, features):
+        """The output layers, on the features of one or many steps (..., features)."""
+        return self.fc2(self.relu(self.fc1(features)))
+
+    @profiled("NTM.step")
+    def step(self, x, prev_state, projected=False):
+        """The recurrent part of :meth:`forward`.
+        Returns the [controller_outp; reads] features of the step, the input
+        of :meth:`output`, and the new state.
         """
         # Unpack the previous state
         prev_reads, prev_controller_state, prev_heads_states = prev_state
 
         # Use the controller to get an embeddings
-        inp = torch.cat([x] + prev_reads, dim=1)
-        controller_outp, controller_state = self.controller(inp, prev_controller_state)
+        with PROFILER.section("NTM.controller"):
+            if projected:
+                inp = torch.cat(prev_reads, dim=1).type_as(x)
+                controller_outp, controller_state = self.controller(inp, prev_controller_state, x)
+            else:
+                inp = torch.cat([x] + prev_reads, dim=1)
+                controller_outp, controller_state = self.controller(inp, prev_controller_state)
 
         # Read/Write from the list of heads
-        reads = []
-        heads_states = []
-        for head, prev_head_state in zip(self.heads, prev_heads_states):
-            if head.is_read_head():
-                r, head_state = head(controller_outp, prev_head_state)
-                reads += [r]
+        with PROFILER.section("NTM.heads"):
+            if isinstance(self.heads, NTMHeadBank):
+                reads, heads_states = self.heads(controller_outp, prev_heads_states)
             else:
-                head_state = head(controller_outp, prev_head_state)
-            heads_states += [head_state]
-
-        # Generate Output
+                reads = []
+                heads_states = []
+                for head, prev_head_state in zip(self.heads, prev_heads_states):
+                    if head.is_read_head():
+                        r, head_state = head(controller_outp, prev_head_state)
+                        reads += [r]
+                    else:
+                        head_state = head(controller_outp, prev_head_state)
+                    heads_states += [head_state]
+
+        # Features for the output layers
         inp2 = torch.cat([controller_outp] + reads, dim=1)
-        o = (self.fc2(self.relu(self.fc1(inp2))))
 
         # Pack the current state
         state = (reads, controller_state, heads_states)
 
-        return o, state
+        return inp2, state
 
 """# ***Task***
 
 Copy
 """
 
-import pandas as pd 
-df = pd.read_csv("finalnifty.csv")
-# date = np.unique(df.date.values)
-date = []
-timestamp = df.Date
-for t in timestamp:
-  date.append(t.split(",")[0])
-df['date'] = date
-p = df.Close.values[::-1]
-
-df.head()
-
-df.drop(0, inplace = True)
-df.reset_index(inplace = True) 
-df.head()
-
-from statsmodels.tsa.api import ExponentialSmoothing, SimpleExpSmoothing, Holt
-# Simple Exponential Smoothing
-y = p
-fit1 = Holt(y).fit(smoothing_level=0.35)
-df['Close'] = fit1.fittedvalues[1:]
-df_gp = df.groupby('date')
-date = np.unique(np.array(date))
-date
+DATA_PATH = "finalnifty.csv"
+DATA_CACHE_PATH = "./"
+SMOOTHING_LEVEL = 0.35
+
+
+def preprocess_days(data_path, smoothing_level):
+    """Reads and smooths the ticks, then splits them per day.
+    Returns the sorted days and, for each day, its min-max normalised
+    sequence in the order it is fed to the NTM.
+    """
+    import pandas as pd 
+    from statsmodels.tsa.api import Holt
+
+    df = pd.read_csv(data_path)
+    date = df.Date.str.split(",").str[0].values
+    df['date'] = date
+    p = df.Close.values[::-1]
+
+    df.drop(0, inplace = True)
+    df.reset_index(inplace = True) 
+
+    # Holt's linear trend smoothing
+    fit1 = Holt(p).fit(smoothing_level=smoothing_level)
+    df['Close'] = fit1.fittedvalues[1:]
+    df_gp = df.groupby('date')
+
+    days = np.unique(date)
+    seqs = []
+    for day in days:
+        seq = df_gp.get_group(day)["Close"].values[::-1]
+        seqs += [(seq - np.min(seq))/(np.max(seq) - np.min(seq))]
+    return days, seqs
+
+
+class DayCache(object):
+    """Preprocessed per-day sequences, memory-mapped from disk.
+    All the days are stored back to back in one flat float32 file, day
+    `dates[i]` is `values[offsets[i]:offsets[i + 1]]`.
+    """
+    def __init__(self, basename):
+        with open(basename + ".json", 'r') as f:
+            index = json.load(f)
+        self.dates = np.array(index["dates"])
+        self.offsets = np.array(index["offsets"], dtype=np.int64)
+        self.values = np.memmap(basename + ".bin", dtype=np.float32, mode='r')
+        self._positions = {day: i for i, day in enumerate(index["dates"])}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, day):
+        """The (read-only) normalised sequence of `day`."""
+        i = self._positions[day]
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @staticmethod
+    def write(basename, days, seqs):
+        offsets = np.cumsum([0] + [len(seq) for seq in seqs])
+        np.concatenate(seqs).astype(np.float32).tofile(basename + ".bin.tmp")
+        os.replace(basename + ".bin.tmp", basename + ".bin")
+
+        # The index goes last, it marks the cache as complete
+        with open(basename + ".json.tmp", 'w') as f:
+            json.dump({"dates": [str(day) for day in days],
+                       "offsets": [int(o) for o in offsets]}, f)
+        os.replace(basename + ".json.tmp", basename + ".json")
+
+
+def load_day_cache(data_path=DATA_PATH, cache_path=DATA_CACHE_PATH,
+                   smoothing_level=SMOOTHING_LEVEL):
+    """Opens the :class:`DayCache` of `data_path`, building it if needed.
+    The cache is keyed by a hash of the source file and of the smoothing
+    parameters, a change in either builds a new one.
+    """
+    key = hashlib.sha1()
+    with open(data_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            key.update(chunk)
+    key.update("holt-{}".format(smoothing_level).encode())
+
+    basename = os.path.join(cache_path, "days-{}".format(key.hexdigest()[:16]))
+    if not os.path.exists(basename + ".json"):
+        days, seqs = preprocess_days(data_path, smoothing_level)
+        DayCache.write(basename, days, seqs)
+    return DayCache(basename)
+
+
+day_cache = load_day_cache()
+date = day_cache.dates
 
 """Copy Task NTM model."""
 
@@ -513,7 +1493,8 @@ def dataloader(num_batches,
                batch_size,
                seq_width,
                min_len,
-               max_len):
+               max_len,
+               start=0):
     """Generator of random sequences for the copy task.
     Creates random batches of "bits" sequences.
     All the sequences within each batch have the same length.
@@ -523,6 +1504,7 @@ def dataloader(num_batches,
     :param batch_size: Batch size.
     :param min_len: Sequence minimum length.
     :param max_len: Sequence maximum length.
+    :param start: Number of batches already trained on, they are skipped.
     NOTE: The input width is `seq_width + 1`, the additional input
     contain the delimiter.
     """
@@ -542,13 +1524,12 @@ def dataloader(num_batches,
 
     #     yield batch_num+1, inp.float(), outp.float()
     
-    for batch_num in range(num_batches):
+    for batch_num in range(start, num_batches):
         batch_day = date[batch_num%len(date)]
 
         # All batches have the same sequence length
 
-        seq = df_gp.get_group(batch_day)["Close"].values[::-1]
-        seq = (seq - np.min(seq))/(np.max(seq) - np.min(seq))
+        seq = day_cache[batch_day]
         seq_len = len(seq)
         seq = seq.reshape(seq_len, batch_size, seq_width)
 
@@ -563,6 +1544,136 @@ def dataloader(num_batches,
         yield batch_num+1, inp.float(), outp.float()
 
 
+def bucketed_dataloader(num_batches,
+                        batch_size,
+                        seq_width,
+                        seed=None,
+                        start=0):
+    """Generator of padded batches of days of similar lengths.
+    The days are sorted by length and cut in buckets of `batch_size` days
+    (the last one may have less), so a batch pads as little as possible; the buckets are visited in a
+    random order every epoch, drawn from a generator of its own so the
+    order only depends on `seed`.
+    The input sequences are left-padded so all the delimiters fall on the
+    same step, the outputs are right-padded. Yields the lengths as well, see
+    `lengths` in :meth:`EncapsulatedNTM.forward_sequence`.
+    :param num_batches: Total number of batches to generate.
+    :param batch_size: Number of days per batch.
+    :param seq_width: The width of each item in the sequence.
+    :param seed: Seed of the bucket order.
+    :param start: Number of batches already trained on, they are skipped.
+    """
+    rng = np.random.RandomState(seed)
+    order = np.argsort(day_cache.lengths(), kind='stable')
+    # The last bucket holds the remaining longest days, it may be smaller
+    buckets = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    num_buckets = len(buckets)
+
+    batch_num = 0
+    while batch_num < num_batches:
+        for bucket in rng.permutation(num_buckets):
+            if batch_num == num_batches:
+                break
+            if batch_num < start:
+                batch_num += 1
+                continue
+            seqs = [day_cache[date[i]].reshape(-1, seq_width) for i in buckets[bucket]]
+            lengths = torch.tensor([len(seq) for seq in seqs])
+            seq_len = int(lengths.max())
+
+            # The input includes an additional channel used for the delimiter
+            inp = torch.zeros(seq_len + 1, len(seqs), seq_width + 1)
+            outp = torch.zeros(seq_len, len(seqs), seq_width)
+            for b, seq in enumerate(seqs):
+                seq = torch.from_numpy(seq.copy())
+                inp[seq_len - len(seq):seq_len, b, :seq_width] = seq
+                outp[:len(seq), b] = seq
+            inp[seq_len, :, seq_width] = 1.0 # delimiter in our control channel
+
+            batch_num += 1
+            yield batch_num, inp, outp, lengths
+
+
+class PrefetchLoader(object):
+    """Builds the next batches of a dataloader in a background thread.
+    Yields the same items as `loader`, at most `depth` of them are built
+    ahead and held in a bounded queue. Tensors are handed over as is, the
+    thread shares the process memory.
+    `wait_ms` accumulates the time the consumer was blocked waiting for data.
+    """
+    _END = object()
+
+    def __init__(self, loader, depth=2):
+        self.loader = loader
+        self.depth = depth
+        self.wait_ms = 0.0
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._worker, name="prefetch", daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        try:
+            for item in self.loader:
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(_LoaderError(e))
+            return
+        self._put(self._END)
+
+    def _put(self, item):
+        """Blocks until there is room in the queue, False if closed meanwhile."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+
+        start = time.perf_counter()
+        item = self._queue.get()
+        self.wait_ms += (time.perf_counter() - start) * 1000
+
+        if item is self._END:
+            self.close()
+            raise StopIteration
+        if isinstance(item, _LoaderError):
+            self.close()
+            raise item.error
+        return item
+
+    def take_wait_ms(self):
+        """Returns the waiting time since the last call."""
+        wait_ms, self.wait_ms = self.wait_ms, 0.0
+        return wait_ms
+
+    def close(self):
+        """Stops the worker thread, dropping the batches built ahead."""
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        self._thread.join()
+        if hasattr(self.loader, 'close'):
+            self.loader.close()
+
+
+class _LoaderError(object):
+    """An exception raised by the wrapped loader, re-raised to the consumer."""
+    def __init__(self, error):
+        self.error = error
+
+
 @attrs
 class CopyTaskParams(object):
     name = attrib(default="copy-task")
@@ -583,6 +1694,7 @@ class CopyTaskParams(object):
     controller_size = attrib(default=224)
     controller_layers = attrib(default=1)
     num_heads = attrib(default=1)
+    fused_heads = attrib(default=False)
     sequence_width = attrib(default=1)
     sequence_min_len = attrib(default=1)
     sequence_max_len = attrib(default=20)
@@ -590,9 +1702,32 @@ class CopyTaskParams(object):
     memory_m = attrib(default=20)
     num_batches = attrib(default=50000)
     batch_size = attrib(default=1)
+    # Number of batches built ahead by a background thread, 0 disables it
+    prefetch_depth = attrib(default=0)
+    # Batch days of similar lengths together (any batch_size)
+    bucketed = attrib(default=False)
     rmsprop_lr = attrib(default=1e-3)
     rmsprop_momentum = attrib(default=0.9)
     rmsprop_alpha = attrib(default=0.95)
+    # Steps per gradient checkpointing segment, 0 keeps every step
+    checkpoint_segment = attrib(default=0)
+    # Rebuild the memory during backward instead of storing it every step
+    reversible_memory = attrib(default=False)
+    # Address only the top K memory rows every step, 0 addresses all of them
+    memory_sparse_k = attrib(default=0)
+    # Address the memory this many rows at a time, 0 addresses all at once
+    memory_chunk_size = attrib(default=0)
+    # Project the inputs of a whole sequence into the controller at once
+    project_inputs = attrib(default=False)
+    # Run the output layers once over all the output steps of a sequence
+    defer_output = attrib(default=False)
+    # Keep the parameters and gradients in one flat buffer each
+    flat_params = attrib(default=False)
+    # Truncated BPTT window in steps, 0 backprops through the whole sequence.
+    # With a window the NTM state also carries over between batches.
+    tbptt_window = attrib(default=0)
+    # Batches already trained on when resuming, the dataloader skips them
+    start_batch = attrib(default=0)
 
 
 #
@@ -625,14 +1760,33 @@ class CopyTaskModelTraining(object):
         net = EncapsulatedNTM(self.params.sequence_width + 1, self.params.sequence_width,
                               self.params.controller_size, self.params.controller_layers,
                               self.params.num_heads,
-                              self.params.memory_n, self.params.memory_m)
+                              self.params.memory_n, self.params.memory_m,
+                              fused_heads=self.params.fused_heads,
+                              checkpoint_segment=self.params.checkpoint_segment,
+                              reversible_memory=self.params.reversible_memory,
+                              sparse_k=self.params.memory_sparse_k,
+                              chunk_size=self.params.memory_chunk_size,
+                              project_inputs=self.params.project_inputs,
+                              defer_output=self.params.defer_output)
+        if self.params.flat_params:
+            net.build_flat_buffer()
         return net
 
     @dataloader.default
     def default_dataloader(self):
-        return dataloader(self.params.num_batches, self.params.batch_size,
-                          self.params.sequence_width,
-                          self.params.sequence_min_len, self.params.sequence_max_len)
+        if self.params.bucketed:
+            loader = bucketed_dataloader(self.params.num_batches, self.params.batch_size,
+                                         self.params.sequence_width,
+                                         seed=np.random.randint(2**31),
+                                         start=self.params.start_batch)
+        else:
+            loader = dataloader(self.params.num_batches, self.params.batch_size,
+                                self.params.sequence_width,
+                                self.params.sequence_min_len, self.params.sequence_max_len,
+                                start=self.params.start_batch)
+        if self.params.prefetch_depth > 0:
+            loader = PrefetchLoader(loader, self.params.prefetch_depth)
+        return loader
 
     @criterion.default
     def default_criterion(self):
@@ -641,11 +1795,192 @@ class CopyTaskModelTraining(object):
 
     @optimizer.default
     def default_optimizer(self):
-        return optim.RMSprop(self.net.parameters(),
+        if self.net.flat_params is not None:
+            params = [self.net.flat_params]
+        else:
+            params = self.net.parameters()
+        return optim.RMSprop(params,
                              momentum=self.params.rmsprop_momentum,
                              alpha=self.params.rmsprop_alpha,
                              lr=self.params.rmsprop_lr)
 
+"""# ***Metrics***
+
+Forecasting metrics computed on whole (seq_len x batch_size x width) batches
+"""
+
+def sequence_mask(lengths, seq_len):
+    """(seq_len x batch_size) mask of the steps within each sequence."""
+    return torch.arange(seq_len).unsqueeze(1) < lengths.unsqueeze(0)
+
+
+def bit_error_cost(y_out, Y, mask=None):
+    """The number of error bits, the outputs are binarized at 0.5."""
+    y_out_binarized = (~(y_out < 0.5)).to(Y.dtype)
+    errors = torch.abs(y_out_binarized - Y)
+    if mask is not None:
+        errors = errors[mask]
+    return torch.sum(errors)
+
+
+def forecast_metrics(y_out, Y, mask=None):
+    """Returns the MSE, directional accuracy and per-step error of a batch.
+    The directional accuracy is the fraction of steps where the predicted
+    move (y_out[t] - y_out[t-1]) has the sign of the true move. The per-step
+    error is the sum over the batch of the absolute error at each step,
+    returned with the number of samples per step. All are tensors, nothing
+    is copied to the host.
+    """
+    if mask is None:
+        mask = torch.ones(Y.size(0), Y.size(1), dtype=torch.bool)
+    m = mask.unsqueeze(-1).to(Y.dtype)
+    abs_errors = torch.abs(y_out - Y) * m
+    count = m.sum() * Y.size(2)
+    mse = torch.sum(abs_errors ** 2) / count
+
+    moves = m[1:] * m[:-1]
+    same_direction = (torch.sign(y_out[1:] - y_out[:-1]) == torch.sign(Y[1:] - Y[:-1])).to(Y.dtype)
+    direction = torch.sum(same_direction * moves) / torch.sum(moves * Y.size(2)).clamp_min(1)
+
+    step_errors = abs_errors.sum(dim=(1, 2))
+    step_counts = m.sum(dim=(1, 2))
+    return mse, direction, step_errors, step_counts
+
+
+class MetricsAccumulator(object):
+    """Per-batch metrics of a training run, in preallocated tensors.
+    Adding a batch doesn't leave torch nor sync with the host, the values
+    are only read when reporting. The per-step errors are summed over the
+    batches since the last :meth:`take_step_errors`.
+    """
+    FIELDS = ('loss', 'cost', 'mse', 'direction', 'seq_len')
+
+    def __init__(self, capacity, max_len=512):
+        self.values = torch.zeros(capacity, len(self.FIELDS))
+        self.step_errors = torch.zeros(max_len)
+        self.step_counts = torch.zeros(max_len)
+        self.count = 0
+
+    def add(self, loss, cost, y_out, Y, mask=None):
+        mse, direction, step_errors, step_counts = forecast_metrics(y_out, Y, mask)
+
+        if self.count == self.values.size(0):
+            self.values = torch.cat([self.values, torch.zeros_like(self.values)])
+        row = self.values[self.count]
+        row[0], row[1], row[4] = loss, cost, Y.size(0)
+        row[2], row[3] = mse, direction
+        self.count += 1
+
+        seq_len = step_errors.size(0)
+        if seq_len > self.step_errors.size(0):
+            grow = seq_len - self.step_errors.size(0)
+            self.step_errors = torch.cat([self.step_errors, torch.zeros(grow)])
+            self.step_counts = torch.cat([self.step_counts, torch.zeros(grow)])
+        self.step_errors[:seq_len] += step_errors
+        self.step_counts[:seq_len] += step_counts
+
+    def column(self, field):
+        return self.values[:self.count, self.FIELDS.index(field)]
+
+    def mean(self, last=None):
+        """Mean of each field over the `last` batches (all by default)."""
+        start = 0 if last is None else max(self.count - last, 0)
+        means = self.values[start:self.count].mean(dim=0).tolist()
+        return dict(zip(self.FIELDS, means))
+
+    def take_step_errors(self, segments=10):
+        """The mean absolute error over each of `segments` equal parts of
+        the steps, since the last call. The sums start over.
+        """
+        seen = int((self.step_counts > 0).sum())
+        errors = self.step_errors[:seen].tensor_split(min(segments, max(seen, 1)))
+        counts = self.step_counts[:seen].tensor_split(min(segments, max(seen, 1)))
+        means = [float(e.sum() / c.sum().clamp_min(1)) for e, c in zip(errors, counts)]
+        self.step_errors.zero_()
+        self.step_counts.zero_()
+        return means
+
+
+# One record per training batch in the metrics log
+METRICS_DTYPE = np.dtype([
+    ('batch', '<i8'),
+    ('loss', '<f4'),
+    ('cost', '<f4'),
+    ('seq_len', '<i4'),
+    ('step_ms', '<f4'),
+])
+
+
+class MetricsLog(object):
+    """Append-only binary log of the per-batch metrics of a training run.
+    Records of `METRICS_DTYPE` are buffered in a preallocated array and
+    appended to the file `chunk_size` at a time, the file is the raw
+    records (see :func:`read_metrics`).
+    A new run truncates the file, a run resuming after `start_batch` keeps
+    the records up to it and drops the ones logged after the checkpoint.
+    """
+    def __init__(self, fname, start_batch=0, chunk_size=1024):
+        self.fname = fname
+        self._buffer = np.zeros(chunk_size, dtype=METRICS_DTYPE)
+        self._count = 0
+        if start_batch and os.path.exists(fname):
+            records = read_metrics(fname)
+            keep = int(np.searchsorted(records['batch'], start_batch, side='right'))
+            del records
+            self._file = open(fname, 'r+b')
+            self._file.truncate(keep * METRICS_DTYPE.itemsize)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(fname, 'wb')
+
+    def append(self, batch_num, loss, cost, seq_len, step_ms):
+        self._buffer[self._count] = (batch_num, loss, cost, seq_len, step_ms)
+        self._count += 1
+        if self._count == len(self._buffer):
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered records."""
+        if self._count:
+            self._file.write(self._buffer[:self._count].tobytes())
+            self._file.flush()
+            self._count = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def read_metrics(fname):
+    """The records of a :class:`MetricsLog` file, memory mapped read only.
+    A record being appended (a partial one at the end) is left out.
+    """
+    num_records = os.path.getsize(fname) // METRICS_DTYPE.itemsize
+    if num_records == 0:
+        return np.zeros(0, dtype=METRICS_DTYPE)
+    return np.memmap(fname, dtype=METRICS_DTYPE, mode='r', shape=(num_records,))
+
+
+def aggregate_metrics(records, every):
+    """Means of the metrics over windows of `every` batches.
+    Returns a dict of arrays with an entry per window: its last batch and
+    the mean of each metric. Reads each field once, memory mapped records
+    of millions of batches are fine.
+    """
+    if len(records) == 0:
+        return {field: np.zeros(0) for field in METRICS_DTYPE.names}
+    # The records are in batch order, so are the windows
+    window = (records['batch'] - 1) // every
+    window -= window[0]
+    counts = np.bincount(window)
+    present = counts > 0
+    counts = counts[present]
+    result = {'batch': np.asarray(records['batch'][np.cumsum(counts) - 1])}
+    for field in ('loss', 'cost', 'seq_len', 'step_ms'):
+        sums = np.bincount(window, weights=records[field])
+        result[field] = sums[present] / counts
+    return result
+
 """# ***Main***
 
 **Utilis**
@@ -688,7 +2023,50 @@ flags_dict = {
     # --- Checkpoint interval ---
     "checkpoint_interval": CHECKPOINT_INTERVAL,
     "checkpoint_path": "./",
+    # Number of checkpoints kept per run, the older ones are deleted (0 keeps all)
+    "checkpoint_keep": 3,
+    # Resume training from the latest checkpoint of the run (same task, params and seed)
+    "resume": False,
     "report_interval": REPORT_INTERVAL,
+    # --- Plots and gradient dumps, every n batches (0 disables them) ---
+    "plot_interval": 0,
+    "grad_interval": 0,
+    "plot_path": "./plots",
+    # --- Time the components of the NTM step, summarized at every report ---
+    "profile": False,
+    # --- Run the gradient checks instead of training ---
+    "check": False,
+    # --- Run the benchmarks instead of training ---
+    "benchmark": False,
+    "benchmark_repeat": 10,
+    # Where to save the results as JSON, and a baseline results file to
+    # compare with: slower than baseline * (1 + tolerance) is a regression
+    "benchmark_output": "",
+    "benchmark_baseline": "",
+    "benchmark_tolerance": 0.25,
+    # --- Replay a day tick by tick instead of training, evaluating the forecast
+    # every `intraday_every` ticks (see evaluate_intraday) ---
+    "intraday_day": "",
+    "intraday_every": 10,
+    # Model to evaluate, the model is untrained without it
+    "intraday_checkpoint": "",
+    # Cache the state after the evaluated prefixes, in MB (0 disables it)
+    "prefix_cache_mb": 256,
+    # --- Serve the model for streaming inference (see InferenceEngine) ---
+    "serve": False,
+    "serve_host": "127.0.0.1",
+    "serve_port": 8765,
+    # Model state dict to serve, the model is untrained without it
+    "serve_checkpoint": "",
+    "max_sessions": 256,
+    # Seconds without ticks before a session is evicted
+    "session_timeout": 300.0,
+    "max_batch": 64,
+    "batch_wait_ms": 2.0,
+    # --- Load test the server with concurrent sessions instead ---
+    "load_test": False,
+    "load_test_sessions": 32,
+    "load_test_ticks": 100,
 }
 save_yaml('./flags.yaml', flags_dict)
 
@@ -703,41 +2081,182 @@ TASKS = {
 }
 
 
-def plot_grad_flow(named_parameters):
-    '''Plots the gradients flowing through different layers in the net during training.
-    Can be used for checking for possible gradient vanishing / exploding problems.
-    
-    Usage: Plug this function in Trainer class after loss.backwards() as 
-    "plot_grad_flow(self.model.named_parameters())" to visualize the gradient flow'''
-    ave_grads = []
-    max_grads= []
+def grad_flow(named_parameters):
+    """Returns the layers with their average and max absolute gradients."""
     layers = []
+    grads = []
     for n, p in named_parameters:
-        if(p.requires_grad) and ("bias" not in n):
+        if(p.requires_grad) and ("bias" not in n) and (p.grad is not None):
             layers.append(n)
-            ave_grads.append(p.grad.abs().mean())
-            max_grads.append(p.grad.abs().max())
-    # plt.bar(np.arange(len(max_grads)), max_grads, alpha=0.1, lw=1, color="c")
-    # plt.bar(np.arange(len(max_grads)), ave_grads, alpha=0.1, lw=1, color="b")
-    # plt.hlines(0, 0, len(ave_grads)+1, lw=2, color="k" )
-    plt.plot(ave_grads, color="g", label="avg")
-    plt.plot(max_grads, color="r", label="max")
-    plt.xticks(range(0,len(ave_grads), 1), layers, rotation="vertical")
-    plt.xlim(left=0, right=len(ave_grads))
-    # plt.ylim(bottom = -0.001, top= 0.2) # zoom in on the lower gradient regions
-    plt.xlabel("Layers")
-    plt.ylabel("average gradient")
-    plt.title("Gradient flow")
-    plt.grid(True)
-    plt.legend()
-    # plt.legend([Line2D([0], [0], color="r", lw=4),
-    #             Line2D([0], [0], color="g", lw=4),
-    #             Line2D([0], [0], color="b", lw=4)], ['max-gradient', 'mean-gradient', 'zero-gradient'])
-    plt.show()
+            grads += [p.grad.abs().mean(), p.grad.abs().max()]
+    # A single device to host copy for all the layers
+    grads = torch.stack(grads).view(-1, 2).tolist() if grads else []
+    ave_grads = [g[0] for g in grads]
+    max_grads = [g[1] for g in grads]
+    return layers, ave_grads, max_grads
+
+
+def plot_grad_flow(ax, layers, ave_grads, max_grads):
+    '''Plots the gradients flowing through different layers in the net during training.
+    Can be used for checking for possible gradient vanishing / exploding problems.
+    
+    Usage: draw the output of "grad_flow(self.model.named_parameters())" after
+    loss.backwards() to visualize the gradient flow (see GradFlowCallback)'''
+    ax.plot(ave_grads, color="g", label="avg")
+    ax.plot(max_grads, color="r", label="max")
+    ax.set_xticks(range(0,len(ave_grads), 1))
+    ax.set_xticklabels(layers, rotation="vertical")
+    ax.set_xlim(left=0, right=len(ave_grads))
+    # ax.set_ylim(bottom = -0.001, top= 0.2) # zoom in on the lower gradient regions
+    ax.set_xlabel("Layers")
+    ax.set_ylabel("average gradient")
+    ax.set_title("Gradient flow")
+    ax.grid(True)
+    ax.legend()
+
+
+def plot_prediction(ax, y_true, y_pred):
+    ax.plot(y_true, label = "True")
+    ax.plot(y_pred, label = "Pred")
+    ax.legend()
+
+
+class AsyncPlotWriter(object):
+    """Renders plots to image files in a background thread.
+    `plot(fname, draw, *args)` queues `draw(ax, *args)` on a new figure.
+    The figures are made with matplotlib's object API (pyplot isn't thread
+    safe). When `max_pending` plots are queued new ones are dropped, so the
+    training loop never waits for rendering.
+    """
+    def __init__(self, max_pending=8):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._worker, name="plots", daemon=True)
+        self._thread.start()
+
+    def plot(self, fname, draw, *args):
+        try:
+            self._queue.put_nowait((fname, draw, args))
+        except queue.Full:
+            LOGGER.debug("Plot queue full, dropping '%s'", fname)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fname, draw, args = item
+            try:
+                fig = Figure(figsize=(10, 6))
+                FigureCanvasAgg(fig)
+                draw(fig.add_subplot(111), *args)
+                fig.tight_layout()
+                fig.savefig(fname)
+            except Exception:
+                LOGGER.exception("Unable to plot '%s'", fname)
+
+    def close(self):
+        """Waits for the queued plots to be written."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+class TrainingCallback(object):
+    """Observer of :func:`train_model`.
+    A hook is called once every `<hook>_every` events, 0 disables it, so
+    expensive work is sampled out of the training loop.
+    """
+    batch_end_every = 0
+    report_every = 0
+    checkpoint_every = 0
+
+    def on_batch_end(self, batch_num, model, x, y, y_out, loss, cost):
+        """After the optimizer step, the gradients are still in `model.net`."""
+        pass
+
+    def on_report(self, batch_num, model, result):
+        """After the evaluation, `result` is returned by :func:`evaluate`."""
+        pass
+
+    def on_checkpoint(self, batch_num, model, basename):
+        pass
+
+    def close(self):
+        pass
+
+
+def notify_callbacks(callbacks, hook, count, *args):
+    """Calls `on_<hook>` for the `count`-th event on the callbacks sampling it."""
+    for callback in callbacks:
+        every = getattr(callback, hook + "_every")
+        if every and count % every == 0:
+            getattr(callback, "on_" + hook)(*args)
+
+
+class PlotPredictionCallback(TrainingCallback):
+    """Plots the first sequence of the batch against its prediction."""
+    def __init__(self, writer, path, every):
+        self.writer = writer
+        self.path = path
+        self.batch_end_every = every
+        self.report_every = 1
+
+    def on_batch_end(self, batch_num, model, x, y, y_out, loss, cost):
+        fname = os.path.join(self.path, "batch-{}.png".format(batch_num))
+        self.writer.plot(fname, plot_prediction, y[:, 0, 0].cpu().numpy(), y_out[:, 0, 0].cpu().numpy())
+
+    def on_report(self, batch_num, model, result):
+        fname = os.path.join(self.path, "eval-batch-{}.png".format(batch_num))
+        self.writer.plot(fname, plot_prediction, result['y'][:, 0, 0].cpu().numpy(),
+                         result['y_out'][:, 0, 0].cpu().numpy())
+
+    def close(self):
+        self.writer.close()
+
+
+class GradFlowCallback(TrainingCallback):
+    """Plots the gradient flow and logs the gradient norms."""
+    def __init__(self, writer, path, every):
+        self.writer = writer
+        self.path = path
+        self.batch_end_every = every
+
+    def on_batch_end(self, batch_num, model, x, y, y_out, loss, cost):
+        named_parameters = [(n, p) for n, p in model.net.named_parameters() if p.grad is not None]
+        norms = torch.stack([p.grad.norm() for _, p in named_parameters]).tolist()
+        for (n, _), norm in zip(named_parameters, norms):
+            LOGGER.debug("Batch %d grad norm %s: %f", batch_num, n, norm)
+        LOGGER.debug("Batch %d grad norm: %f", batch_num, grad_norm(model.net))
+
+        fname = os.path.join(self.path, "grads-batch-{}.png".format(batch_num))
+        self.writer.plot(fname, plot_grad_flow, *grad_flow(named_parameters))
+
+    def close(self):
+        self.writer.close()
+
+
+def init_callbacks(args):
+    """Builds the plotting callbacks enabled in the arguments."""
+    callbacks = []
+    if args.plot_interval or args.grad_interval:
+        os.makedirs(args.plot_path, exist_ok=True)
+        writer = AsyncPlotWriter()
+        if args.plot_interval:
+            callbacks += [PlotPredictionCallback(writer, args.plot_path, args.plot_interval)]
+        if args.grad_interval:
+            callbacks += [GradFlowCallback(writer, args.plot_path, args.grad_interval)]
+    return callbacks
+
+
 def get_ms():
     """Returns the current time in miliseconds."""
     return time.time() * 1000
 
+
+def get_peak_rss_mb():
+    """Returns the peak resident set size of the process in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
 def init_seed(seed=None):
     """Seed the RNGs for predicatability/reproduction purposes."""
     if seed is None:
@@ -762,173 +2281,430 @@ def progress_bar(batch_num, report_interval, last_loss):
         "=" * fill, " " * (40 - fill), batch_num, last_loss), end='')
 
 
-def save_checkpoint(net, name, args, batch_num, losses, costs, seq_lengths):
-    progress_clean()
+CHECKPOINT_FORMAT = 1
+
+
+def _to_cpu(obj):
+    """Copies the tensors of a nested dict/list/tuple to the CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
 
-    basename = "{}/{}-{}-batch-{}".format(args.checkpoint_path, name, args.seed, batch_num)
-    model_fname = basename + ".model"
-    LOGGER.info("Saving model checkpoint to: '%s'", model_fname)
-    torch.save(net.state_dict(), model_fname)
-
-    # Save the training history
-    train_fname = basename + ".json"
-    LOGGER.info("Saving model training history to '%s'", train_fname)
-    content = {
-        "loss": losses,
-        "cost": costs,
-        "seq_lengths": seq_lengths
+
+def get_rng_state():
+    """The state of all the RNGs seeded by :func:`init_seed`."""
+    state = {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
     }
-    open(train_fname, 'wt').write(json.dumps(content))
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restores a state returned by :func:`get_rng_state`."""
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _atomic_write(fname, write):
+    """Calls `write(f)` on a temporary file renamed to `fname` once synced,
+    so `fname` is either the previous version or the complete new one.
+    """
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints in a background thread.
+    `write(basename, snapshot)` queues a snapshot already copied to the
+    CPU, so training goes on while it is written. At most one checkpoint
+    waits for the writer, a second one blocks until it's taken.
+    After each write only the last `keep` checkpoints of the run are kept,
+    0 keeps all of them.
+    """
+    def __init__(self, keep=0):
+        self.keep = keep
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._worker, name="checkpoints", daemon=True)
+        self._thread.start()
+
+    def write(self, basename, snapshot):
+        self._queue.put((basename, snapshot))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            basename, snapshot = item
+            try:
+                _atomic_write(basename + ".ckpt", lambda f: torch.save(snapshot, f))
+                LOGGER.debug("Checkpoint '%s' written", basename)
+                if self.keep:
+                    self._apply_retention(basename)
+            except Exception:
+                LOGGER.exception("Unable to write checkpoint '%s'", basename)
+
+    def _apply_retention(self, basename):
+        prefix = re.sub(r"-batch-\d+$", "", basename)
+        for batch_num, fname in checkpoint_files(prefix)[:-self.keep]:
+            try:
+                os.remove(fname + ".ckpt")
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """Waits for the queued checkpoints to be written."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+def checkpoint_prefix(args, name):
+    return "{}/{}-{}".format(args.checkpoint_path, name, args.seed)
+
+
+def checkpoint_files(prefix):
+    """The (batch_num, basename) of the checkpoints starting with `prefix`, oldest first."""
+    directory, name = os.path.split(prefix)
+    pattern = re.compile(re.escape(name) + r"-batch-(\d+)\.ckpt$")
+    found = []
+    for fname in os.listdir(directory or "."):
+        m = pattern.match(fname)
+        if m:
+            found.append((int(m.group(1)), os.path.join(directory, fname[:-len(".ckpt")])))
+    return sorted(found)
+
+
+def load_latest_checkpoint(args, name):
+    """Loads the latest checkpoint of the run, None if there's none."""
+    found = checkpoint_files(checkpoint_prefix(args, name))
+    if not found:
+        return None
+    batch_num, basename = found[-1]
+    LOGGER.info("Resuming from checkpoint '%s'", basename + ".ckpt")
+    checkpoint = torch.load(basename + ".ckpt", map_location='cpu', weights_only=False)
+    assert checkpoint["format"] == CHECKPOINT_FORMAT, \
+        "Unsupported checkpoint format {}".format(checkpoint["format"])
+    return checkpoint
+
+
+def load_weights(net, fname):
+    """Loads a training checkpoint, or a bare state dict, into `net`."""
+    state = torch.load(fname, map_location='cpu', weights_only=False)
+    net.load_state_dict(state.get("model", state))
+
+
+def checkpoint_snapshot(model, batch_num, tbptt=False):
+    """A CPU copy of everything needed to resume training after `batch_num`."""
+    return {
+        "format": CHECKPOINT_FORMAT,
+        "batch_num": batch_num,
+        "model": _to_cpu(model.net.state_dict()),
+        "optimizer": _to_cpu(model.optimizer.state_dict()),
+        "rng": _to_cpu(get_rng_state()),
+        "version": model.net.version,
+        # With truncated BPTT the sequence goes on in the next batch
+        "net_state": _to_cpu(model.net.get_state()) if tbptt else None,
+    }
+
+
+def restore_checkpoint(model, checkpoint):
+    """Restores a snapshot made by :func:`checkpoint_snapshot`.
+    The dataloader isn't restored, it is created after
+    `checkpoint["batch_num"]` with `start_batch`.
+    """
+    model.net.load_state_dict(checkpoint["model"])
+    model.optimizer.load_state_dict(checkpoint["optimizer"])
+    set_rng_state(checkpoint["rng"])
+    model.net.version = checkpoint["version"]
+    if checkpoint["net_state"] is not None:
+        # The state goes where the model is, the snapshot is on the CPU
+        net_device = next(model.net.parameters()).device
+        model.net.set_state([s.to(net_device) for s in checkpoint["net_state"]])
+
+
+def save_checkpoint(writer, model, args, batch_num):
+    """Queues a checkpoint to `writer`, returns its basename.
+    The training history is in the metrics log, see :class:`MetricsLog`.
+    """
+    progress_clean()
+
+    basename = "{}-batch-{}".format(checkpoint_prefix(args, model.params.name), batch_num)
+    LOGGER.info("Saving checkpoint to: '%s'", basename + ".ckpt")
+    snapshot = checkpoint_snapshot(model, batch_num, model.params.tbptt_window > 0)
+    writer.write(basename, snapshot)
+    return basename
 
 
 def clip_grads(net):
     """Gradient clipping to the range [10, 10]."""
+    if net.flat_params is not None:
+        net.flat_params.grad.clamp_(-5, 5)
+        return
     parameters = list(filter(lambda p: p.grad is not None, net.parameters()))
     for p in parameters:
         p.grad.data.clamp_(-5, 5)
 
 
-def train_batch(net, criterion, optimizer, X, Y):
-    """Trains a single batch."""
-    optimizer.zero_grad()
-    inp_seq_len = X.size(0) # inp_seq_len, batch_size, inp_seq_dim
+def zero_grads(net, optimizer):
+    """Resets the gradients, in place for a flat buffer (see :meth:`EncapsulatedNTM.build_flat_buffer`)."""
+    if net.flat_params is not None:
+        net.flat_params.grad.zero_()
+    else:
+        optimizer.zero_grad()
+
+
+def all_params(net):
+    """All the parameters of `net` as a single vector."""
+    if net.flat_params is not None:
+        return net.flat_params
+    return torch.cat([x.view(-1) for x in net.parameters()])
+
+
+def grad_norm(net):
+    """The global L2 norm of the gradients."""
+    if net.flat_params is not None:
+        return net.flat_params.grad.norm()
+    return torch.stack([p.grad.norm() for p in net.parameters() if p.grad is not None]).norm()
+
+
+def train_batch(net, criterion, optimizer, X, Y, lengths=None):
+    """Trains a single batch.
+    :param lengths: Length of each sequence for padded batches (see
+          :func:`bucketed_dataloader`), the padding is left out of the loss.
+    """
+    zero_grads(net, optimizer)
     outp_seq_len, batch_size, _ = Y.size()
     Y_label = Y.permute(1, 0, 2).clone()
 
     # New sequence
     net.init_sequence(batch_size) # initialize memory, LSTM controller, read_heads
 
-    # Feed the sequence + delimiter
-    for i in range(inp_seq_len):
-        net(X[i])
-
-    # Read the output (no input given)
-    y_out = torch.zeros(Y.size())
-    for i in range(outp_seq_len):
-        y_out[i], _ = net()
+    # Feed the sequence + delimiter, then read the output (no input given)
+    y_out = net.forward_sequence(X, outp_seq_len, lengths)
     y_pred = y_out.permute(1, 0, 2).clone()
-    plt.plot(X.cpu().detach().numpy()[:-1, 0, 0], label = "True")
-    plt.plot(y_out.cpu().detach().numpy()[:, 0, 0], label = "Pred")
-    plt.legend()
-    plt.show()
 
-    loss = criterion(y_pred, Y_label)
+    if lengths is None:
+        mask = None
+        loss = criterion(y_pred, Y_label)
+    else:
+        mask = sequence_mask(lengths, outp_seq_len)
+        loss = criterion(y_out[mask], Y[mask])
     lambda1 = 0.2
-    all_linear1_params = torch.cat([x.view(-1) for x in net.parameters()])
+    all_linear1_params = all_params(net)
     l1_regularization = lambda1 * torch.norm(all_linear1_params, 1)
     #loss += l1_regularization
     
     loss.backward()
     # clip_grads(net)
-    plot_grad_flow(net.named_parameters())
-    for n, p in net.named_parameters():
-      print(n, p.grad.norm())
-    
     optimizer.step()
-
-    y_out_binarized = y_out.clone().data
-    y_out_binarized.apply_(lambda x: 0 if x < 0.5 else 1)
+    net.version += 1
 
     # The cost is the number of error bits per sequence
-    cost = torch.sum(torch.abs(y_out_binarized - Y.data))
-
-    return loss.item(), cost.item() / batch_size
+    cost = bit_error_cost(y_out.detach(), Y, mask)
 
+    return loss.item(), cost.item() / batch_size, y_out.detach()
 
-def evaluate(net, criterion, X):
 
-    """Evaluate a single batch (without training)."""
+def train_batch_tbptt(net, criterion, optimizer, X, Y, window):
+    """Trains a single batch with truncated backprop through time.
+    The NTM state is carried over from the previous batch. The steps of the
+    sequence (input phase, then output phase) are split in windows of
+    `window` steps, the state is detached at each window boundary and every
+    window holding output steps does its own optimizer step.
+    """
     inp_seq_len = X.size(0)
-    outp_seq_len, batch_size, _ = X.size()
+    outp_seq_len, batch_size, _ = Y.size()
+    y_out = torch.zeros(Y.size())
+    total_loss = 0
 
-    # New sequence
-    net.init_sequence(batch_size)
+    for start in range(0, inp_seq_len + outp_seq_len, window):
+        end = min(start + window, inp_seq_len + outp_seq_len)
+        outp_start = max(start - inp_seq_len, 0)
+        outp_end = max(end - inp_seq_len, 0)
+
+        # Windows without outputs get no gradient, only the state moves on
+        with torch.set_grad_enabled(outp_end > outp_start):
+            zero_grads(net, optimizer)
+            y = net.forward_sequence(X[start:min(end, inp_seq_len)], outp_end - outp_start)
 
-    # Feed the sequence + delimiter
-    states = []
-    for i in range(inp_seq_len):
+            if outp_end > outp_start:
+                loss = criterion(y, Y[outp_start:outp_end])
+                loss.backward()
+                optimizer.step()
+                net.version += 1
+                y_out[outp_start:outp_end] = y.detach()
+                total_loss += loss.item() * (outp_end - outp_start)
 
-        o, state = net(X[i])
-        states += [state]
+        net.detach_state()
 
-    # Read the output (no input given)
-    y_out = torch.zeros(X.size())
-    for i in range(outp_seq_len):
-        y_out[i], state = net()
-        states += [state]
+    # The cost is the number of error bits per sequence
+    cost = bit_error_cost(y_out, Y)
 
-    plt.plot(X.cpu().detach().numpy()[:-1, 0, 0], label = "True")
-    plt.plot(y_out.cpu().detach().numpy()[:, 0, 0], label = "Pred")
-    plt.legend()
-    plt.show()
-    loss = criterion(y_out, X)
+    return total_loss / outp_seq_len, cost.item() / batch_size, y_out
 
-    # y_out_binarized = y_out.clone().data
-    # y_out_binarized.apply_(lambda x: 0 if x < 0.5 else 1)
 
-    # The cost is the number of error bits per sequence
-    # cost = torch.sum(torch.abs(y_out_binarized - Y.data))
+def evaluate(net, criterion, X, cache=None):
+
+    """Evaluate a single batch (without training).
+    :param cache: Optional :class:`PrefixStateCache` for the input phase.
+    """
+    outp_seq_len, batch_size, _ = X.size()
+
+    # New sequence, feed the sequence + delimiter, then read the output (no input given)
+    if cache is not None:
+        y_out = net.forward_sequence_cached(X, outp_seq_len, cache)
+    else:
+        net.init_sequence(batch_size)
+        y_out = net.forward_sequence(X, outp_seq_len)
+
+    loss = criterion(y_out.expand_as(X), X)
+
+    # The output phase has one step more than the sequence
+    Y = X[:-1, :, :net.num_outputs]
+    y_out = y_out.detach()
+    mse, direction, _, _ = forecast_metrics(y_out[:Y.size(0)], Y)
+
+    result = {
+        'loss': loss.item(),
+        # The cost is the number of error bits per sequence
+        'cost': bit_error_cost(y_out[:Y.size(0)], Y).item() / batch_size,
+        'mse': mse.item(),
+        'direction': direction.item(),
+        'y': Y,
+        'y_out': y_out,
+    }
 
-    # result = {
-    #     'loss': loss.data[0],
-    #     # 'cost': cost / batch_size,
-    #     'y_out': y_out,
-    #     # 'y_out_binarized': y_out_binarized,
-    #     'states': states
-    # }
+    return result
 
-    # return result
 
+def delimited_input(seq):
+    """The (seq_len + 1) x 1 x 2 input of a single day `seq`, the delimiter
+    on the control channel after it.
+    """
+    seq_len = len(seq)
+    inp = torch.zeros(seq_len + 1, 1, 2)
+    inp[:seq_len, :, :1] = torch.from_numpy(seq.reshape(seq_len, 1, 1).copy())
+    inp[seq_len, :, 1] = 1.0 # delimiter in our control channel
+    return inp
+
+
+def evaluate_intraday(net, criterion, seq, every, cache=None):
+    """Evaluates the forecast of a day as its ticks come in.
+    The prefix of the day is evaluated every `every` ticks, each one
+    extends the previous, so with a :class:`PrefixStateCache` only the new
+    ticks go through the input phase.
+    :return: list of (ticks, result of :func:`evaluate`)
+    """
+    results = []
+    with torch.no_grad():
+        for ticks in range(every, len(seq) + 1, every):
+            results += [(ticks, evaluate(net, criterion, delimited_input(seq[:ticks]), cache))]
+    return results
 
-def train_model(model, args):
+
+def train_model(model, args, callbacks=(), checkpoint=None):
+    """Trains the model, `callbacks` are :class:`TrainingCallback` hooks.
+    `checkpoint` is restored first, from :func:`load_latest_checkpoint`.
+    """
     num_batches = model.params.num_batches
     batch_size = model.params.batch_size
 
     LOGGER.info("Training model for %d batches (batch_size=%d)...",
                 num_batches, batch_size)
 
-    losses = []
-    costs = []
-    seq_lengths = []
+    metrics = MetricsAccumulator(num_batches)
     start_ms = get_ms()
 
-    for batch_num, x, y in model.dataloader:
-        
-        loss, cost = train_batch(model.net, model.criterion, model.optimizer, x, y)
-        losses += [loss]
-        costs += [cost]
-        seq_lengths += [y.size(0)]
+    tbptt_window = model.params.tbptt_window
+    assert not (tbptt_window > 0 and model.params.bucketed), \
+        "Truncated BPTT carries one sequence per batch slot, it can't be bucketed"
+    if tbptt_window > 0:
+        # A single sequence going through all the batches
+        model.net.init_sequence(batch_size)
+    if checkpoint is not None:
+        restore_checkpoint(model, checkpoint)
+    writer = CheckpointWriter(args.checkpoint_keep) if args.checkpoint_interval else None
+    metrics_log = MetricsLog(checkpoint_prefix(args, model.params.name) + ".metrics",
+                             model.params.start_batch)
+
+    for batch_num, x, y, *lengths in model.dataloader:
+        step_start = time.perf_counter()
+        if tbptt_window > 0:
+            loss, cost, y_out = train_batch_tbptt(model.net, model.criterion, model.optimizer,
+                                                  x, y, tbptt_window)
+        else:
+            loss, cost, y_out = train_batch(model.net, model.criterion, model.optimizer,
+                                            x, y, *lengths)
+        mask = sequence_mask(lengths[0], y.size(0)) if lengths else None
+        metrics.add(loss, cost, y_out, y, mask)
+        metrics_log.append(batch_num, loss, cost, y.size(0),
+                           (time.perf_counter() - step_start) * 1000)
+        notify_callbacks(callbacks, "batch_end", batch_num,
+                         batch_num, model, x, y, y_out, loss, cost)
 
         # Update the progress bar
         progress_bar(batch_num, args.report_interval, loss)
 
         # Report
         if batch_num % args.report_interval == 0:
-            seq = df_gp.get_group("2020/07/07")["Close"].values[::-1]
-            seq = (seq - np.min(seq))/(np.max(seq) - np.min(seq))
-            seq_len = len(seq)
-            seq = seq.reshape(seq_len, batch_size, 1)
-            seq = torch.from_numpy(seq.copy())
-
-            # The input includes an additional channel used for the delimiter
-            inp = torch.zeros(seq_len + 1, batch_size, 2)
-            inp[:seq_len, :, :1] = seq
-            inp[seq_len, :, 1] = 1.0 # delimiter in our control channel
-   
-            evaluate(model.net, model.criterion, inp)
-            mean_loss = np.array(losses[-args.report_interval:]).mean()
-            mean_cost = np.array(costs[-args.report_interval:]).mean()
+            inp = delimited_input(day_cache["2020/07/07"])
+
+            if tbptt_window > 0:
+                state = model.net.get_state()
+            result = evaluate(model.net, model.criterion, inp)
+            if tbptt_window > 0:
+                model.net.set_state(state)
+            notify_callbacks(callbacks, "report", batch_num // args.report_interval,
+                             batch_num, model, result)
+            mean = metrics.mean(last=args.report_interval)
             mean_time = int(((get_ms() - start_ms) / args.report_interval) / batch_size)
             progress_clean()
-            LOGGER.info("Batch %d Loss: %.6f Cost: %.2f Time: %d ms/sequence",
-                        batch_num, mean_loss, mean_cost, mean_time)
+            LOGGER.info("Batch %d Loss: %.6f Cost: %.2f MSE: %.6f Direction: %.3f "
+                        "Time: %d ms/sequence Peak RSS: %d MB",
+                        batch_num, mean['loss'], mean['cost'], mean['mse'], mean['direction'],
+                        mean_time, get_peak_rss_mb())
+            LOGGER.info("Eval Loss: %.6f Cost: %.2f MSE: %.6f Direction: %.3f",
+                        result['loss'], result['cost'], result['mse'], result['direction'])
+            LOGGER.info("Step MAE by tenth of the sequence: %s",
+                        " ".join("{:.4f}".format(v) for v in metrics.take_step_errors()))
+            if isinstance(model.dataloader, PrefetchLoader):
+                LOGGER.info("Waited for data: %.2f ms/batch",
+                            model.dataloader.take_wait_ms() / args.report_interval)
+            if PROFILER.enabled:
+                LOGGER.info("Profile of the last %d batches:\n%s",
+                            args.report_interval, PROFILER.summary())
+                PROFILER.reset()
             start_ms = get_ms()
 
         # Checkpoint
         if (args.checkpoint_interval != 0) and (batch_num % args.checkpoint_interval == 0):
-            save_checkpoint(model.net, model.params.name, args,
-                            batch_num, losses, costs, seq_lengths)
-
+            # The log covers at least the batches of the checkpoint
+            metrics_log.flush()
+            basename = save_checkpoint(writer, model, args, batch_num)
+            notify_callbacks(callbacks, "checkpoint", batch_num // args.checkpoint_interval,
+                             batch_num, model, basename)
+
+    metrics_log.close()
+    if writer is not None:
+        writer.close()
+    for callback in callbacks:
+        callback.close()
     LOGGER.info("Done training.")
 
 
@@ -958,12 +2734,13 @@ def update_model_params(params, update):
 
     return params
 
-def init_model(args):
+def init_model(args, start_batch=0):
     LOGGER.info("Training for the **%s** task", args.task)
 
     model_cls, params_cls = TASKS[args.task]
     params = params_cls()
     params = update_model_params(params, args.param)
+    params = attr.evolve(params, start_batch=start_batch)
 
     LOGGER.info(params)
 
@@ -976,6 +2753,682 @@ def init_logging():
                         level=logging.DEBUG)
   
 
+"""**Snapshots**"""
+
+SNAPSHOT_MAGIC = b"NTMSTATE"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sII") # magic, version, meta length
+SNAPSHOT_ALIGN = 64
+
+
+def _align(offset):
+    return (offset + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+
+
+def save_state_snapshot(path, tensors, meta=None):
+    """Writes tensors (e.g. :meth:`EncapsulatedNTM.get_state`) to a single binary file.
+    The file is a fixed header, a JSON description of the tensors (dtype,
+    shape, offset) plus `meta`, then the raw tensor data, each tensor
+    aligned on 64 bytes. It's written next to `path` and moved in place.
+    """
+    arrays = [t.detach().cpu().contiguous().numpy() for t in tensors]
+    entries = []
+    offset = 0
+    for a in arrays:
+        entries += [{"dtype": a.dtype.str, "shape": list(a.shape), "offset": offset}]
+        offset = _align(offset + a.nbytes)
+    content = json.dumps({"tensors": entries, "meta": meta or {}}).encode()
+    data_start = _align(SNAPSHOT_HEADER.size + len(content))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(content)))
+        f.write(content)
+        for a, entry in zip(arrays, entries):
+            f.seek(data_start + entry["offset"])
+            f.write(memoryview(a).cast('B'))
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_state_snapshot(path):
+    """Maps a file written by :func:`save_state_snapshot`, without copying it.
+    The tensors are views of a copy-on-write mapping of the file: pages are
+    read on first access, and writing to a tensor copies only its touched
+    pages, never the file.
+    :return: the list of tensors and the meta dict
+    """
+    with open(path, 'rb') as f:
+        magic, version, length = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("'{}' is not an NTM state snapshot".format(path))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version {} in '{}'".format(version, path))
+        content = json.loads(f.read(length).decode())
+
+    data_start = _align(SNAPSHOT_HEADER.size + length)
+    data = np.memmap(path, dtype=np.uint8, mode='c')
+    tensors = []
+    for entry in content["tensors"]:
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"]))
+        a = np.frombuffer(data, dtype, count, data_start + entry["offset"])
+        tensors += [torch.from_numpy(a.reshape(entry["shape"]))]
+    return tensors, content["meta"]
+
+
+"""**Prefix state cache**"""
+
+class PrefixStateCache(object):
+    """LRU cache of the NTM state after an input prefix, bounded in bytes.
+    A prefix is keyed by a chain of hashes, key_i = sha1(key_{i-1} + X[i]),
+    started from the model version and the batch shape, so the keys of all
+    the prefixes of a sequence cost one pass over it. See
+    :meth:`EncapsulatedNTM.forward_sequence_cached`.
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = collections.OrderedDict() # key -> (state, nbytes)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def prefix_keys(X, version):
+        """The keys of X[:1], X[:2], ..., X for a model at `version`."""
+        h = hashlib.sha1("{}:{}".format(version, tuple(X.size()[1:])).encode())
+        keys = []
+        for x in X.detach().cpu().numpy():
+            h.update(x.tobytes())
+            keys += [h.copy().digest()]
+        return keys
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def lookup(self, keys):
+        """The longest cached prefix of `keys`, as (its length, its state), or (0, None)."""
+        for i in range(len(keys) - 1, -1, -1):
+            if keys[i] in self.entries:
+                return i + 1, self.get(keys[i])
+        self.misses += 1
+        return 0, None
+
+    def put(self, key, state):
+        state = tuple(s.detach() for s in state)
+        nbytes = sum(s.numel() * s.element_size() for s in state)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = (state, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= evicted
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+"""**Inference**"""
+
+class InferenceEngine(object):
+    """Steps many independent NTM streams ("sessions") in batches.
+    The state of every session (reads, LSTM h/c, head weightings, memory)
+    lives in a slot of a table with `max_sessions` rows per state tensor.
+    A step gathers the slots of the sessions in the batch, runs the net once
+    under `torch.inference_mode` and scatters the new state back. The net is
+    owned by the engine, its own state is overwritten at every step.
+    The methods can be called from any thread, a lock serializes them so a
+    slot isn't freed or reused while a step is running.
+    """
+    def __init__(self, net, max_sessions=64, idle_timeout=300.0):
+        self.net = net.eval()
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = {} # session_id -> [slot, last_seen]
+        self.free_slots = list(range(max_sessions - 1, -1, -1))
+        self.lock = threading.Lock()
+
+        with torch.inference_mode():
+            net.init_sequence(1)
+            self.dims = net.get_state_batch_dims()
+            # The state of a new sequence is views of the biases, copy it
+            # so the steps never write to the parameters
+            self.initial_state = [s.clone(memory_format=torch.contiguous_format)
+                                  for s in net.get_state()]
+            self.table = []
+            for s, d in zip(self.initial_state, self.dims):
+                size = list(s.size())
+                size[d] = max_sessions
+                self.table += [s.expand(size).clone(memory_format=torch.contiguous_format)]
+
+    def _slot(self, session_id, now):
+        """The slot of a session, a new session gets a freshly reset one."""
+        if session_id in self.sessions:
+            session = self.sessions[session_id]
+            session[1] = now
+            return session[0]
+
+        if not self.free_slots:
+            self._evict_idle(now)
+        if not self.free_slots:
+            raise RuntimeError("All {} session slots are in use".format(self.max_sessions))
+
+        slot = self.free_slots.pop()
+        for t, s, d in zip(self.table, self.initial_state, self.dims):
+            t.narrow(d, slot, 1).copy_(s)
+        self.sessions[session_id] = [slot, now]
+        return slot
+
+    def _close_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.free_slots.append(session[0])
+
+    def close_session(self, session_id):
+        """Frees the slot of a session, an unknown session is ignored."""
+        with self.lock:
+            self._close_session(session_id)
+
+    def _evict_idle(self, now):
+        idle = [sid for sid, (_, last_seen) in self.sessions.items()
+                if now - last_seen > self.idle_timeout]
+        for sid in idle:
+            self._close_session(sid)
+        return len(idle)
+
+    def evict_idle(self, now=None):
+        """Closes the sessions idle for more than `idle_timeout` seconds.
+        :return: the number of evicted sessions
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return self._evict_idle(now)
+
+    def save_snapshot(self, path):
+        """Saves the slot table and the sessions, see :func:`save_state_snapshot`."""
+        with self.lock:
+            sessions = {sid: slot for sid, (slot, _) in self.sessions.items()}
+            save_state_snapshot(path, self.table, {"config": self.net.state_config(), "sessions": sessions})
+
+    def load_snapshot(self, path):
+        """Restores the sessions saved by :meth:`save_snapshot`, memory mapped.
+        The sessions count as just seen.
+        """
+        table, meta = load_state_snapshot(path)
+        if meta.get("config") != self.net.state_config():
+            raise ValueError("Snapshot '{}' is of another model: {}".format(path, meta.get("config")))
+        if table[0].size(self.dims[0]) != self.max_sessions:
+            raise ValueError("Snapshot '{}' has another number of session slots".format(path))
+        now = time.monotonic()
+        used = set(meta["sessions"].values())
+        with self.lock:
+            self.table = table
+            self.sessions = {sid: [slot, now] for sid, slot in meta["sessions"].items()}
+            self.free_slots = [slot for slot in range(self.max_sessions - 1, -1, -1) if slot not in used]
+
+    def step(self, requests):
+        """A single NTM step for each of the (session_id, x) `requests`.
+        A session can appear only once, x is its input (num_inputs).
+        :return: the outputs (len(requests) x num_outputs)
+        """
+        now = time.monotonic()
+        with self.lock, torch.inference_mode():
+            slots = torch.tensor([self._slot(sid, now) for sid, _ in requests])
+            x = torch.stack([x for _, x in requests])
+            self.net.set_state([t.index_select(d, slots) for t, d in zip(self.table, self.dims)])
+            o, _ = self.net(x)
+            for t, d, s in zip(self.table, self.dims, self.net.get_state()):
+                t.index_copy_(d, slots, s)
+        return o
+
+
+class InferenceStats(object):
+    """Latencies and batch sizes of the served requests.
+    The percentiles are over the last `window` latencies only, so a long
+    running server doesn't keep one entry per request.
+    """
+    def __init__(self, window=10000):
+        self.start = time.perf_counter()
+        self.latencies_ms = collections.deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.batched_requests = 0
+
+    def add_latency(self, ms):
+        self.latencies_ms.append(ms)
+        self.requests += 1
+
+    def add_batch(self, size):
+        self.batches += 1
+        self.batched_requests += size
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        latencies = np.array(self.latencies_ms or [0.0])
+        return {
+            "requests": self.requests,
+            "throughput_per_s": self.requests / elapsed,
+            "latency_p50_ms": float(np.percentile(latencies, 50)),
+            "latency_p95_ms": float(np.percentile(latencies, 95)),
+            "latency_p99_ms": float(np.percentile(latencies, 99)),
+            "mean_batch_size": self.batched_requests / self.batches if self.batches else 0.0,
+        }
+
+
+class DynamicBatcher(object):
+    """Groups the concurrently submitted ticks into :class:`InferenceEngine` steps.
+    :meth:`run` is an asyncio task: once a tick is pending it waits up to
+    `max_wait_ms` for others to join, then steps up to `max_batch` sessions
+    at once in a worker thread. Later ticks of a session already in the
+    batch wait for the next step.
+    """
+    def __init__(self, engine, max_batch=64, max_wait_ms=2.0):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.stats = InferenceStats()
+        self.pending = []
+        self.wakeup = asyncio.Event()
+
+    async def submit(self, session_id, x):
+        """Queues a tick of a session, returns its output."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending += [(session_id, x, future, time.perf_counter())]
+        self.wakeup.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            if len(self.pending) < self.max_batch:
+                await asyncio.sleep(self.max_wait_ms / 1000)
+
+            batch, later, sessions = [], [], set()
+            for item in self.pending:
+                if len(batch) < self.max_batch and item[0] not in sessions:
+                    batch += [item]
+                    sessions.add(item[0])
+                else:
+                    later += [item]
+            self.pending = later
+            if not later:
+                self.wakeup.clear()
+
+            try:
+                o = await loop.run_in_executor(None, self.engine.step, [(sid, x) for sid, x, _, _ in batch])
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            now = time.perf_counter()
+            self.stats.add_batch(len(batch))
+            for (_, _, future, start), y in zip(batch, o):
+                self.stats.add_latency((now - start) * 1000)
+                future.set_result(y)
+            self.engine.evict_idle()
+
+
+async def serve_inference(batcher, host, port):
+    """Starts a TCP server speaking a line protocol:
+    "<session_id> <x_1> ... <x_n>" answers the outputs of the step, missing
+    inputs (e.g. the delimiter) are 0. "close <session_id>" ends a session.
+    Failures answer "error <message>".
+    """
+    num_inputs = batcher.engine.net.num_inputs
+
+    async def handle(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            fields = line.decode().split()
+            try:
+                if fields[0] == "close":
+                    # Waits for a running step, off the event loop
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, batcher.engine.close_session, fields[1])
+                    reply = "ok"
+                else:
+                    x = torch.zeros(num_inputs)
+                    values = [float(v) for v in fields[1:]]
+                    if len(values) > num_inputs:
+                        raise ValueError("At most {} inputs".format(num_inputs))
+                    x[:len(values)] = torch.tensor(values)
+                    y = await batcher.submit(fields[0], x)
+                    reply = " ".join("{:.6f}".format(v) for v in y.tolist())
+            except (IndexError, ValueError, RuntimeError) as e:
+                reply = "error {}".format(e)
+            writer.write((reply + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def run_load_test(batcher, host, port, num_sessions, ticks):
+    """Streams `ticks` random ticks on each of `num_sessions` concurrent connections.
+    Every client waits for the answer of a tick before sending the next one.
+    :return: the server side stats and the client round trip stats
+    """
+    server = await serve_inference(batcher, host, port)
+    runner = asyncio.ensure_future(batcher.run())
+    client_stats = InferenceStats()
+
+    async def client(i):
+        reader, writer = await asyncio.open_connection(host, port)
+        for _ in range(ticks):
+            start = time.perf_counter()
+            writer.write("session-{} {:.6f}\n".format(i, random.random()).encode())
+            await writer.drain()
+            reply = await reader.readline()
+            if reply.startswith(b"error"):
+                raise RuntimeError(reply.decode().strip())
+            client_stats.add_latency((time.perf_counter() - start) * 1000)
+        writer.write("close session-{}\n".format(i).encode())
+        await reader.readline()
+        writer.close()
+
+    try:
+        await asyncio.gather(*[client(i) for i in range(num_sessions)])
+    finally:
+        runner.cancel()
+        server.close()
+        await server.wait_closed()
+    return batcher.stats.summary(), client_stats.summary()
+
+
+def run_inference(args):
+    """Serves the model, or load tests the server, as set in the arguments."""
+    model = init_model(args)
+    if args.serve_checkpoint:
+        load_weights(model.net, args.serve_checkpoint)
+    engine = InferenceEngine(model.net, args.max_sessions, args.session_timeout)
+    batcher = DynamicBatcher(engine, args.max_batch, args.batch_wait_ms)
+
+    if args.load_test:
+        server_stats, client_stats = asyncio.run(run_load_test(
+            batcher, args.serve_host, args.serve_port, args.load_test_sessions, args.load_test_ticks))
+        LOGGER.info("Server: %s", json.dumps(server_stats))
+        LOGGER.info("Clients: %s", json.dumps(client_stats))
+        return 0
+
+    async def serve():
+        server = await serve_inference(batcher, args.serve_host, args.serve_port)
+        LOGGER.info("Serving on %s:%d", args.serve_host, args.serve_port)
+        await asyncio.gather(server.serve_forever(), batcher.run())
+
+    asyncio.run(serve())
+    return 0
+
+
+def run_intraday(args):
+    """Replays a day with :func:`evaluate_intraday`, as set in the arguments."""
+    model = init_model(args)
+    if args.intraday_checkpoint:
+        load_weights(model.net, args.intraday_checkpoint)
+    model.net.eval()
+    cache = PrefixStateCache(args.prefix_cache_mb * 2**20) if args.prefix_cache_mb else None
+
+    start_ms = get_ms()
+    results = evaluate_intraday(model.net, model.criterion, day_cache[args.intraday_day],
+                                args.intraday_every, cache)
+    for ticks, result in results:
+        LOGGER.info("%s after %d ticks, Loss: %.6f MSE: %.6f Direction: %.3f",
+                    args.intraday_day, ticks, result['loss'], result['mse'], result['direction'])
+    LOGGER.info("Replayed %d evaluations in %d ms", len(results), get_ms() - start_ms)
+    if cache is not None:
+        LOGGER.info("Prefix cache: %d hits, %d misses", cache.hits, cache.misses)
+    return 0
+
+
+"""**Checks**"""
+
+def check_reversible_functions():
+    """gradcheck of the hand written backward of the reversible memory ops.
+    :return: the names of the failing ops
+    """
+    bs, H, N, M = 2, 2, 6, 4
+    memory = torch.randn(bs, N, M, dtype=torch.double, requires_grad=True)
+    w = F.softmax(torch.randn(bs, N, dtype=torch.double), dim=-1).requires_grad_()
+    w_heads = F.softmax(torch.randn(bs, H, N, dtype=torch.double), dim=-1).requires_grad_()
+    e = (0.9 * torch.rand(bs, M, dtype=torch.double)).requires_grad_()
+    a = torch.randn(bs, M, dtype=torch.double, requires_grad=True)
+    k = torch.randn(bs, H, M, dtype=torch.double, requires_grad=True)
+
+    # Each call gets its own tape, holding the memory it's given
+    checks = {
+        "_ReversibleWrite": (lambda mem, w, e, a: _ReversibleWrite.apply(mem, w, e, a, _MemoryTape(mem)),
+                             (memory, w, e, a)),
+        "_ReversibleRead": (lambda mem, w: _ReversibleRead.apply(mem, w, _MemoryTape(mem)),
+                            (memory, w_heads)),
+        "_ReversibleSimilarity": (lambda mem, k: _ReversibleSimilarity.apply(mem, k, _MemoryTape(mem)),
+                                  (memory, k)),
+    }
+    failed = []
+    for name, (fn, inputs) in checks.items():
+        ok = torch.autograd.gradcheck(fn, inputs, raise_exception=False)
+        LOGGER.info("gradcheck %s: %s", name, "ok" if ok else "FAILED")
+        if not ok:
+            failed.append(name)
+    return failed
+
+
+def check_reversible_memory(seq_len=376, batch_size=4, N=128, M=20, focused=True):
+    """Compares the float32 gradients of a reversible memory NTM with the
+    ones of the same NTM keeping every memory, over a trading day.
+    The erase isn't scaled (max_erase=1) so both are the same model. With
+    `focused`, the write head is biased to write to one row at a time with
+    an almost full erase, the worst case for rebuilding the memory.
+    :return: the largest relative error of the gradient of a parameter
+    """
+    grads = []
+    for reversible in (False, True):
+        torch.manual_seed(0)
+        net = EncapsulatedNTM(2, 1, 224, 1, 1, N, M, reversible_memory=reversible)
+        net.memory.max_erase = 1.0
+        if focused:
+            # Biases of β, γ and e, see NTMWriteHead.write_lengths
+            with torch.no_grad():
+                bias = net.ntm.heads[1].fc_write.bias
+                bias[M] = bias[M + 5] = 20.0
+                bias[M + 6:2 * M + 6] = 6.0
+        torch.manual_seed(1)
+        x = torch.randn(seq_len, batch_size, 2)
+        net.init_sequence(batch_size)
+        y = torch.stack([net(x[t])[0] for t in range(seq_len)])
+        y.pow(2).mean().backward()
+        grads.append([p.grad for p in net.parameters()])
+
+    error = max(float((g - g_ref).norm() / g_ref.norm().clamp_min(1e-30))
+                for g_ref, g in zip(*grads))
+    LOGGER.info("Reversible memory gradients, %d steps: relative error %.3g", seq_len, error)
+    return error
+
+
+def run_checks(args):
+    """Runs the gradient checks, returns 1 if one fails."""
+    failed = check_reversible_functions()
+    for focused in (False, True):
+        error = check_reversible_memory(focused=focused)
+        if not error < 1e-4:
+            failed.append("reversible memory (focused={})".format(focused))
+    for name in failed:
+        LOGGER.error("Check failed: %s", name)
+    return 1 if failed else 0
+
+
+"""**Benchmarks**"""
+
+# Every benchmark runs at the defaults, then with one of them changed
+BENCHMARK_DEFAULTS = {"N": 400, "M": 20, "batch_size": 1, "num_heads": 1, "seq_len": 20}
+BENCHMARK_SWEEP = {
+    "N": [128, 400, 1024, 4096],
+    "M": [20, 64],
+    "batch_size": [1, 8, 32],
+    "num_heads": [1, 2, 4],
+    "seq_len": [20, 100],
+}
+
+
+def benchmark_configs(defaults=BENCHMARK_DEFAULTS, sweep=BENCHMARK_SWEEP):
+    configs = [dict(defaults)]
+    for k, values in sweep.items():
+        for v in values:
+            if v != defaults[k]:
+                configs += [dict(defaults, **{k: v})]
+    return configs
+
+
+def time_op(fn, repeat=10, warmup=2):
+    """Returns the median wall time of `fn()` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times += [(time.perf_counter() - start) * 1000]
+    return float(np.median(times))
+
+
+def benchmark_memory(config, repeat):
+    """Times the :class:`NTMMemory` operations of a single head step."""
+    N, M, bs = config["N"], config["M"], config["batch_size"]
+    memory = NTMMemory(N, M)
+    memory.reset(bs)
+    k, e, a = torch.randn(bs, M), torch.rand(bs, M), torch.randn(bs, M)
+    β, g, γ = F.softplus(torch.randn(bs, 1)), torch.rand(bs, 1), 1 + F.softplus(torch.randn(bs, 1))
+    s = F.softmax(torch.randn(bs, 3), dim=1)
+    w = F.softmax(torch.randn(bs, N), dim=1)
+
+    return {
+        "NTMMemory.address": time_op(lambda: memory.address(k, β, g, s, γ, w), repeat),
+        "NTMMemory._similarity": time_op(lambda: memory._similarity(k, β), repeat),
+        "NTMMemory._shift": time_op(lambda: memory._shift(w, s), repeat),
+        "NTMMemory._sharpen": time_op(lambda: memory._sharpen(w, γ), repeat),
+        "NTMMemory.read": time_op(lambda: memory.read(w), repeat),
+        "NTMMemory.write": time_op(lambda: memory.write(w, e, a), repeat),
+    }
+
+
+def benchmark_model(config, repeat):
+    """Times the controller, a single NTM step and a whole train_batch."""
+    N, M, bs, H = config["N"], config["M"], config["batch_size"], config["num_heads"]
+    net = EncapsulatedNTM(2, 1, 224, 1, H, N, M)
+    controller = net.ntm.controller
+    criterion = nn.MSELoss()
+    optimizer = optim.RMSprop(net.parameters(), momentum=0.9, alpha=0.95, lr=1e-4)
+
+    X = torch.rand(config["seq_len"] + 1, bs, 2)
+    X[-1] = 0
+    X[-1, :, 1] = 1.0 # delimiter
+    Y = X[:-1, :, :1].clone()
+    x = torch.cat([X[0]] + [torch.zeros(bs, M)] * H, dim=1)
+
+    net.init_sequence(bs)
+    with torch.no_grad():
+        results = {
+            "LSTMController.forward": time_op(
+                lambda: controller(x, controller.create_new_state(bs)), repeat),
+            "NTM.forward": time_op(lambda: net(X[0]), repeat),
+        }
+    results["train_batch"] = time_op(lambda: train_batch(net, criterion, optimizer, X, Y),
+                                     max(repeat // 5, 1), warmup=1)
+    return results
+
+
+BENCHMARK_SPARSE_K = 8
+
+
+def benchmark_sparse(config, repeat):
+    """Times an inference step with dense and with top-K sparse addressing."""
+    N, M, bs = config["N"], config["M"], config["batch_size"]
+    x = torch.rand(bs, 2)
+    results = {}
+    for name, sparse_k in [("dense", 0), ("sparse", BENCHMARK_SPARSE_K)]:
+        net = EncapsulatedNTM(2, 1, 224, 1, 1, N, M, sparse_k=sparse_k)
+        net.init_sequence(bs)
+        with torch.no_grad():
+            results["NTM.forward " + name] = time_op(lambda: net(x), repeat)
+    return results
+
+
+BENCHMARKS = [
+    # name, function, the config keys it depends on, configs
+    ("memory", benchmark_memory, ("N", "M", "batch_size"), benchmark_configs()),
+    ("model", benchmark_model, ("N", "M", "batch_size", "num_heads", "seq_len"), benchmark_configs()),
+    ("sparse", benchmark_sparse, ("N", "M", "batch_size"),
+     benchmark_configs(sweep={"N": [1024, 4096, 16384, 65536]})),
+]
+
+
+def run_benchmark_suite(repeat=10, configs=None):
+    """Returns a list of {"name", "params", "ms"} records.
+    :param configs: Run every benchmark on these instead of its own configs.
+    """
+    results = []
+    for _, fn, keys, default_configs in BENCHMARKS:
+        done = set()
+        for config in configs or default_configs:
+            params = {k: config[k] for k in keys}
+            key = json.dumps(params, sort_keys=True)
+            if key in done:
+                continue
+            done.add(key)
+            LOGGER.info("Benchmarking %s %s", fn.__name__, key)
+            for name, ms in fn(config, repeat).items():
+                results += [{"name": name, "params": params, "ms": ms}]
+    return results
+
+
+def benchmark_key(record):
+    return record["name"] + json.dumps(record["params"], sort_keys=True)
+
+
+def compare_benchmarks(results, baseline, tolerance):
+    """Returns the results slower than their baseline by more than `tolerance`."""
+    baseline_ms = {benchmark_key(r): r["ms"] for r in baseline}
+    regressions = []
+    for r in results:
+        base = baseline_ms.get(benchmark_key(r))
+        if base is not None and r["ms"] > base * (1 + tolerance):
+            regressions += [dict(r, baseline_ms=base)]
+    return regressions
+
+
+def run_benchmarks(args):
+    """Runs the benchmarks, returns 1 on regressions against the baseline."""
+    results = run_benchmark_suite(args.benchmark_repeat)
+    print(json.dumps(results, indent=1))
+
+    if args.benchmark_output:
+        with open(args.benchmark_output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.benchmark_baseline:
+        with open(args.benchmark_baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_benchmarks(results, baseline, args.benchmark_tolerance)
+        for r in regressions:
+            LOGGER.error("Regression %s %s: %.3f ms (baseline %.3f ms)",
+                         r["name"], json.dumps(r["params"], sort_keys=True), r["ms"], r["baseline_ms"])
+        if regressions:
+            return 1
+    return 0
+
+
 def main():
     init_logging()
 
@@ -985,11 +3438,33 @@ def main():
     # Initialize random
     init_seed(args.seed)
 
+    PROFILER.enabled = args.profile
+
+    if args.check:
+        sys.exit(run_checks(args))
+
+    if args.benchmark:
+        sys.exit(run_benchmarks(args))
+
+    if args.serve or args.load_test:
+        sys.exit(run_inference(args))
+
+    if args.intraday_day:
+        sys.exit(run_intraday(args))
+
+    # The latest checkpoint to resume from
+    checkpoint = None
+    if args.resume:
+        params = update_model_params(TASKS[args.task][1](), args.param)
+        checkpoint = load_latest_checkpoint(args, params.name)
+        if checkpoint is None:
+            LOGGER.info("No checkpoint to resume from, starting over")
+
     # Initialize the model
-    model = init_model(args)                                                             
+    model = init_model(args, checkpoint["batch_num"] if checkpoint else 0)
 
     LOGGER.info("Total number of parameters: %d", model.net.calculate_num_params())
-    train_model(model, args)
+    train_model(model, args, init_callbacks(args), checkpoint)
 
 
 if __name__ == '__main__':